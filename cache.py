@@ -0,0 +1,356 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+def _digest(x):
+    """
+    Args:
+        x: Tensor on cpu
+    Returns:
+        digest: hex string of the contents of x
+    """
+    return hashlib.blake2b(x.contiguous().numpy().tobytes(), digest_size=16).hexdigest()
+
+
+def fingerprint(branch, memo=None):
+    """
+    Hash of the class and the attributes (tensors included) of every module in branch.
+
+    Args:
+        branch: tuple of modules
+        memo: dict id -> (version, data_ptr, digest), to avoid rehashing tensors that didn't change
+    Returns:
+        fingerprint: hex string
+    """
+    memo = {} if memo is None else memo
+
+    def tensor_digest(x):
+        state = (x._version, x.data_ptr())
+        if id(x) not in memo or memo[id(x)][0] != state:
+            memo[id(x)] = (state, _digest(x.detach().cpu()))
+        return memo[id(x)][1]
+
+    h = hashlib.blake2b(digest_size=16)
+    for module in branch:
+        for name, m in module.named_modules():
+            h.update(f"{name}:{type(m).__name__}".encode())
+            for key, value in sorted(vars(m).items()):
+                if key.startswith("_") or key == "training":
+                    continue
+                h.update(key.encode())
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    value = float(value)    # end=7 and end=7.0 (e.g. from a command line) build the same layer
+                h.update(tensor_digest(value).encode() if isinstance(value, torch.Tensor) else repr(value).encode())
+            for key, value in list(m.named_parameters(recurse=False)) + list(m.named_buffers(recurse=False)):
+                h.update(key.encode())
+                h.update(tensor_digest(value).encode())
+    return h.hexdigest()
+
+
+class SharedStore:
+    STALE_SECONDS = 3600    # temporary files older than this are left over from writers that died
+
+    def __init__(self, directory, max_bytes=2**34, low_water=0.9):
+        """
+        Content-addressed feature files on local disk, shared by concurrent processes (e.g. the trials of a sweep).
+        Files are written to a temporary name and renamed into place, which is atomic, so readers never see partial
+        entries and writers need no lock. Once the directory exceeds max_bytes, least recently used files are removed
+        down to low_water * max_bytes; a reader that loses that race simply misses.
+        The size of the directory is tracked as its size at the last scan plus the writes of this process, and it is only
+        scanned again once that exceeds max_bytes or this process wrote (1 - low_water) * max_bytes, which bounds what
+        other processes can add unseen.
+
+        Args:
+            directory: Directory of the store
+            max_bytes: Size cap of the directory
+            low_water: Fraction of max_bytes kept after an eviction
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.size = None        # approximate size of the directory, scanned on the first write
+        self.next_scan = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[-2:], key + ".npy")     # keys end with the digest of the sample
+
+    def get(self, key):
+        """
+        Returns:
+            value: Tensor, or None if key is not in the store
+        """
+        path = self._path(key)
+        try:
+            value = torch.from_numpy(np.load(path))
+            os.utime(path)      # recency for eviction
+        except FileNotFoundError:   # not written yet or evicted meanwhile
+            return None
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, value.numpy())
+            size = f.tell()
+        try:
+            os.replace(tmp, path)
+        except FileNotFoundError:   # removed as stale by another process, the entry is just not stored
+            return
+        if self.size is None:
+            self.evict()
+        self.size += size
+        if self.size > self.next_scan:
+            self.evict()
+
+    def evict(self):
+        """
+        Scans the directory and, if it exceeds max_bytes, removes least recently used files down to low_water * max_bytes.
+        Temporary files of writes in progress are left alone, only those older than STALE_SECONDS are removed.
+        """
+        files, now = [], time.time()
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                for file in os.scandir(entry.path):
+                    try:
+                        stat = file.stat()
+                        if file.name.endswith(".tmp"):
+                            if now - stat.st_mtime > self.STALE_SECONDS:
+                                os.remove(file.path)
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, file.path))
+        total = sum(size for _, size, _ in files)
+        if total > self.max_bytes:
+            for _, size, path in sorted(files):
+                if total <= self.low_water * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self.size = total
+        self.next_scan = min(self.max_bytes, total + (1 - self.low_water) * self.max_bytes)
+
+
+class MemmapRows:
+    def __init__(self, path, row_shape, dtype=np.float32):
+        """
+        Rows of equal shape appended to one memory-mapped file, which grows by doubling.
+
+        Args:
+            path: File of the rows
+            row_shape: Shape of each row
+            dtype: numpy dtype of the rows
+        """
+        self.path = path
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.num_rows, self.capacity = 0, 0
+        self.array = None
+
+    def _grow(self, capacity):
+        if self.array is not None:
+            self.array.flush()
+        row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape))
+        with open(self.path, "ab") as f:
+            f.truncate(capacity * row_bytes)
+        self.array = np.memmap(self.path, self.dtype, "r+", shape=(capacity, *self.row_shape))
+        self.capacity = capacity
+
+    def append(self, value):
+        """
+        Returns:
+            row: position of value
+        """
+        if self.num_rows == self.capacity:
+            self._grow(max(2 * self.capacity, 1024))
+        self.array[self.num_rows] = value.numpy()
+        self.num_rows += 1
+        return self.num_rows - 1
+
+    def __getitem__(self, row):
+        return torch.from_numpy(np.array(self.array[row]))
+
+
+class FeatureCache:
+    def __init__(self, max_bytes=2**30, spill_dir=None, shared_dir=None, shared_max_bytes=2**34, backend="memory"):
+        """
+        Per-sample cache of deterministic features (e.g. DTM followed by EC_Layer or PL_Layer), so that they are computed
+        only in the first epoch. Entries are keyed by a hash of the contents of the sample and a fingerprint of the configuration
+        of the branch that computes them, so a changed configuration never hits stale entries, which are dropped.
+        Least recently used entries beyond max_bytes are spilled to disk if spill_dir is given, otherwise discarded.
+        With backend "memmap", all entries are instead rows of one memory-mapped file per configuration in spill_dir, for
+        datasets whose features don't fit in memory. With shared_dir, entries missing in memory are looked up in a SharedStore
+        before being computed, so that processes running the same configuration on the same data (e.g. sweep trials) compute
+        each feature only once.
+
+        Args:
+            max_bytes: Memory budget of the cached features
+            spill_dir: Directory for features that don't fit in memory, private to this cache
+            shared_dir: Directory of a SharedStore
+            shared_max_bytes: Size cap of the SharedStore
+            backend: "memory" or "memmap"
+        """
+        assert backend in ("memory", "memmap")
+        assert backend == "memory" or spill_dir is not None, "memmap backend needs spill_dir"
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.backend = backend
+        self.rows = {}                  # (config, sample) -> row of self.memmaps[config]
+        self.memmaps = {}               # config -> MemmapRows
+        self.memory = OrderedDict()     # (config, sample) -> Tensor
+        self.disk = set()               # (config, sample) on disk
+        self.nbytes = 0
+        self.configs = {}               # branch -> fingerprint of its current configuration
+        self._tensor_digests = {}       # id -> (version, data_ptr, digest), to avoid rehashing unchanged tensors
+        self.shared = None if shared_dir is None else SharedStore(shared_dir, shared_max_bytes)
+        self.hits, self.misses = 0, 0
+        self._lock = threading.RLock()  # branches of a model may share the cache from several threads, see run_branches
+
+    def __call__(self, input, branch):
+        """
+        Args:
+            input: Tensor of shape [batch_size, ...]
+            branch: tuple of modules applied one after the other, with no learnable parameters before the output
+        Returns:
+            output: Tensor of shape [batch_size, ...], same as applying branch to input
+        """
+        if torch.is_grad_enabled() and input.requires_grad:     # features depend on something learnable, don't cache
+            return self._apply(branch, input)
+        samples = [_digest(x) for x in input.detach().cpu()]
+        with self._lock:
+            config = self._fingerprint(branch)
+            output = [self._get((config, sample)) for sample in samples]
+        if self.shared is not None:
+            for i in [i for i, x in enumerate(output) if x is None]:
+                output[i] = self.shared.get(config + samples[i])
+                if output[i] is not None:
+                    with self._lock:
+                        self._put((config, samples[i]), output[i])
+        missing = [i for i, x in enumerate(output) if x is None]
+        with self._lock:
+            self.hits += len(samples) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            with torch.no_grad():
+                computed = self._apply(branch, input[missing]).detach().cpu()
+            for i, x in zip(missing, computed):
+                output[i] = x.clone()   # don't keep the storage of the whole batch alive
+                with self._lock:
+                    self._put((config, samples[i]), output[i])
+                if self.shared is not None:
+                    self.shared.put(config + samples[i], output[i])
+        return torch.stack(output).to(input.device)
+
+    @staticmethod
+    def _apply(branch, input):
+        for module in branch:
+            input = module(input)
+        return input
+
+    def _fingerprint(self, branch):
+        """
+        If the configuration of the branch changed since the last call, its old entries are dropped.
+        """
+        config = fingerprint(branch, self._tensor_digests)
+        branch_id = tuple(id(module) for module in branch)
+        old = self.configs.get(branch_id)
+        if old is not None and old != config:
+            self.invalidate(old)
+        self.configs[branch_id] = config
+        return config
+
+    def _path(self, key):
+        return os.path.join(self.spill_dir, key[0], key[1] + ".pt")
+
+    def _get(self, key):
+        if key in self.rows:
+            return self.memmaps[key[0]][self.rows[key]]
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if key in self.disk:
+            value = torch.load(self._path(key))
+            self.disk.remove(key)
+            os.remove(self._path(key))
+            self._put(key, value)
+            return value
+        return None
+
+    def _put(self, key, value):
+        if self.backend == "memmap":
+            if key[0] not in self.memmaps:
+                os.makedirs(os.path.join(self.spill_dir, key[0]), exist_ok=True)
+                self.memmaps[key[0]] = MemmapRows(os.path.join(self.spill_dir, key[0], "rows.bin"), value.shape,
+                                                  value.numpy().dtype)
+            self.rows[key] = self.memmaps[key[0]].append(value)
+            return
+        self.memory[key] = value
+        self.nbytes += value.nelement() * value.element_size()
+        while self.nbytes > self.max_bytes and len(self.memory) > 1:
+            old_key, old_value = self.memory.popitem(last=False)
+            self.nbytes -= old_value.nelement() * old_value.element_size()
+            if self.spill_dir is not None:
+                os.makedirs(os.path.join(self.spill_dir, old_key[0]), exist_ok=True)
+                torch.save(old_value, self._path(old_key))
+                self.disk.add(old_key)
+
+    def invalidate(self, config=None):
+        """
+        Drops the entries of config, or all entries if config is None.
+        """
+        for key in [key for key in self.memory if config is None or key[0] == config]:
+            value = self.memory.pop(key)
+            self.nbytes -= value.nelement() * value.element_size()
+        self.disk = {key for key in self.disk if config is not None and key[0] != config}
+        self.rows = {key: row for key, row in self.rows.items() if config is not None and key[0] != config}
+        self.memmaps = {name: rows for name, rows in self.memmaps.items() if config is not None and name != config}
+        if self.spill_dir is not None:
+            for name in ([config] if config is not None else os.listdir(self.spill_dir) if os.path.isdir(self.spill_dir) else []):
+                shutil.rmtree(os.path.join(self.spill_dir, name), ignore_errors=True)
+
+
+def topo_branch(input, dtm, topo_layer, cache=None):
+    """
+    Same as topo_layer(dtm(input)). With a cache, the output of the EC/PL layer is taken from the cache and
+    only gtheta_layer of topo_layer is applied.
+
+    Args:
+        input: Tensor of shape [batch_size, C, H, W]
+        dtm: DTMLayer or None
+        topo_layer: EC_TopoLayer or PL_TopoLayer
+        cache: FeatureCache or None
+    Returns:
+        output: Tensor of shape [batch_size, out_features]
+    """
+    if cache is None:
+        return topo_layer(input if dtm is None else dtm(input))
+    vectorization = topo_layer.ec_layer if hasattr(topo_layer, "ec_layer") else topo_layer.pl_layer
+    branch = (vectorization,) if dtm is None else (dtm, vectorization)
+    return topo_layer.head(cache(input, branch))
+
+
+def make_cache(feature_cache):
+    """
+    Args:
+        feature_cache: FeatureCache, dict of its arguments (e.g. from a config) or None. A dict with the key "precomputed"
+                       gives PrecomputedFeatures of that directory (see precompute.py), with a FeatureCache of the other
+                       arguments, if any, for the samples not in it
+    """
+    if isinstance(feature_cache, dict) and "precomputed" in feature_cache:
+        from precompute import PrecomputedFeatures  # precompute imports this module
+        arguments = {k: v for k, v in feature_cache.items() if k != "precomputed"}
+        return PrecomputedFeatures(feature_cache["precomputed"], FeatureCache(**arguments) if arguments else None)
+    return FeatureCache(**feature_cache) if isinstance(feature_cache, dict) else feature_cache
@@ -0,0 +1,141 @@
+import torch
+
+
+class DiagramBatch:
+    def __init__(self, birth, death, index, offsets, num_channels, dimensions, size):
+        """
+        Persistence diagrams of a batch of images stored as flat tensors (CSR layout).
+        Points are grouped in order of batch_size, channel and dimension, and the points of group g are
+        birth[offsets[g]-offsets[0]:offsets[g+1]-offsets[0]]. offsets[0] can be nonzero for slices, which share storage with the original.
+
+        Args:
+            birth: Tensor of shape [n, ]
+            death: Tensor of shape [n, ]
+            index: Tensor of shape [n, 2], position of birth and death pixel in the flattened sample of shape [(C*H*W)],
+                   -1 if the value doesn't depend on a pixel (e.g. deaths truncated at a cutoff)
+            offsets: Tensor of shape [(batch_size*C*len_dim) + 1]
+            num_channels: Number of channels of the images
+            dimensions: Homology dimensions of the diagrams
+            size: list or tuple in the form of [H, W]
+        """
+        self.birth = birth
+        self.death = death
+        self.index = index
+        self.offsets = offsets
+        self.num_channels = num_channels
+        self.dimensions = list(dimensions)
+        self.size = list(size)
+
+    @property
+    def groups_per_sample(self):
+        return self.num_channels * len(self.dimensions)
+
+    @property
+    def num_groups(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        """
+        Number of points in each (sample, channel, dimension), shape: [num_groups, ]
+        """
+        return self.offsets.diff()
+
+    @property
+    def group(self):
+        """
+        Group that each point belongs to, shape: [n, ]
+        """
+        return torch.repeat_interleave(torch.arange(self.num_groups, device=self.offsets.device), self.counts)
+
+    def __len__(self):
+        return self.num_groups // self.groups_per_sample
+
+    def __getitem__(self, ind):
+        """
+        Zero-copy slicing over samples.
+        """
+        if isinstance(ind, int):
+            ind = slice(ind, ind + 1) if ind != -1 else slice(ind, None)
+        start, stop, step = ind.indices(len(self))
+        assert step == 1, "only contiguous slices are supported"
+        offsets = self.offsets[start*self.groups_per_sample:stop*self.groups_per_sample + 1]
+        lo, hi = offsets[0] - self.offsets[0], offsets[-1] - self.offsets[0]
+        return DiagramBatch(self.birth[lo:hi], self.death[lo:hi], self.index[lo:hi], offsets,
+                            self.num_channels, self.dimensions, self.size)
+
+    def diagram(self, b, c, d):
+        """
+        Args:
+            b: sample
+            c: channel
+            d: position of the homology dimension in self.dimensions
+        Returns:
+            pd: persistence diagram, shape: [n, 2]
+        """
+        g = (b * self.num_channels + c) * len(self.dimensions) + d
+        lo, hi = self.offsets[g] - self.offsets[0], self.offsets[g+1] - self.offsets[0]
+        return torch.stack((self.birth[lo:hi], self.death[lo:hi]), 1)
+
+    def global_index(self):
+        """
+        Position of birth and death pixel in the flattened batch of shape [(batch_size*C*H*W)], shape: [n, 2]
+        """
+        sample = self.group // self.groups_per_sample
+        shift = (sample * self.num_channels * self.size[0] * self.size[1]).unsqueeze(-1)
+        return torch.where(self.index < 0, self.index, self.index + shift)
+
+    def _apply(self, fn):
+        return DiagramBatch(fn(self.birth), fn(self.death), fn(self.index), fn(self.offsets),
+                            self.num_channels, self.dimensions, self.size)
+
+    def to(self, *args, **kwargs):
+        return self._apply(lambda x: x.to(*args, **kwargs))
+
+    def pin_memory(self):
+        """
+        Called by DataLoader when pin_memory=True.
+        """
+        return self._apply(lambda x: x.pin_memory())
+
+    def share_memory_(self):
+        """
+        Moves the underlying storage to shared memory so that worker processes can hand off diagrams without copying.
+        """
+        for x in (self.birth, self.death, self.index, self.offsets):
+            x.share_memory_()
+        return self
+
+    def clone(self):
+        """
+        Copy that owns its storage, also rebasing offsets of slices to start at zero.
+        """
+        offsets = self.offsets - self.offsets[0]
+        return DiagramBatch(self.birth.clone(), self.death.clone(), self.index.clone(), offsets,
+                            self.num_channels, self.dimensions, self.size)
+
+    def save(self, path):
+        db = self.clone()   # torch.save writes the whole storage of a view
+        torch.save({"birth": db.birth, "death": db.death, "index": db.index, "offsets": db.offsets,
+                    "num_channels": db.num_channels, "dimensions": db.dimensions, "size": db.size}, path)
+
+    @classmethod
+    def load(cls, path, map_location="cpu"):
+        return cls(**torch.load(path, map_location=map_location))
+
+    @classmethod
+    def cat(cls, diagram_list):
+        """
+        Concatenates DiagramBatch's of the same configuration along the batch dimension.
+        """
+        first = diagram_list[0]
+        offsets = [first.offsets[:1] - first.offsets[0]]
+        shift = 0
+        for db in diagram_list:
+            offsets.append(db.offsets[1:] - db.offsets[0] + shift)
+            shift += db.offsets[-1] - db.offsets[0]
+        return cls(torch.cat([db.birth for db in diagram_list]),
+                   torch.cat([db.death for db in diagram_list]),
+                   torch.cat([db.index for db in diagram_list]),
+                   torch.cat(offsets),
+                   first.num_channels, first.dimensions, first.size)
@@ -0,0 +1,190 @@
+import math
+import numpy as np
+import torch
+from diagram import DiagramBatch
+
+
+def _directions(num_directions):
+    """
+    Returns:
+        directions: Tensor of shape [2, num_directions], unit vectors with angles evenly spaced in [-pi/2, pi/2)
+    """
+    theta = -math.pi / 2 + math.pi * torch.arange(num_directions) / num_directions
+    return torch.stack((torch.cos(theta), torch.sin(theta)))
+
+
+def _projections(points, directions):
+    """
+    Args:
+        points: Tensor of shape [..., n, 2]
+        directions: Tensor of shape [2, M]
+    Returns:
+        proj: Tensor of shape [..., n, M], projection of the points on each direction
+        diag_proj: Tensor of shape [..., n, M], projection of the orthogonal projections of the points on the diagonal
+    """
+    proj = points @ directions
+    diag_proj = (points.mean(-1, keepdim=True) * directions.sum(0))
+    return proj, diag_proj
+
+
+def _padded(diagrams, groups):
+    """
+    Args:
+        diagrams: DiagramBatch
+        groups: Tensor of shape [P, ], groups to gather
+    Returns:
+        points: Tensor of shape [P, n_max, 2], padded with (0, 0), which lies on the diagonal and doesn't change any distance
+    """
+    offsets = diagrams.offsets - diagrams.offsets[0]
+    start, counts = offsets[groups], offsets[groups + 1] - offsets[groups]
+    n_max = max(int(counts.max()) if len(groups) else 0, 1)
+    pos = torch.arange(n_max)
+    mask = pos < counts.unsqueeze(-1)                                   # shape: [P, n_max]
+    ind = (start.unsqueeze(-1) + pos).clamp(max=max(len(diagrams.birth) - 1, 0))
+    points = torch.stack((diagrams.birth[ind], diagrams.death[ind]), -1) if len(diagrams.birth) else torch.zeros(len(groups), n_max, 2)
+    return points * mask.unsqueeze(-1)
+
+
+def sliced_wasserstein(points_a, points_b, directions):
+    """
+    Exact sliced Wasserstein distance between pairs of diagrams (Carriere et al., 2017) on the given directions. No autograd.
+    Each diagram is completed with the diagonal projections of the other one, so that both have the same number of points.
+
+    Args:
+        points_a: Tensor of shape [P, n, 2]
+        points_b: Tensor of shape [P, m, 2]
+        directions: Tensor of shape [2, M]
+    Returns:
+        distance: Tensor of shape [P, ]
+    """
+    proj_a, diag_a = _projections(points_a, directions)
+    proj_b, diag_b = _projections(points_b, directions)
+    # numpy sorts many short rows much faster than torch
+    u = torch.cat((proj_a, diag_b), 1).transpose(1, 2).contiguous().numpy()    # shape: [P, M, (n+m)]
+    v = torch.cat((proj_b, diag_a), 1).transpose(1, 2).contiguous().numpy()
+    u.sort(-1)
+    v.sort(-1)
+    return torch.from_numpy(np.abs(u - v).sum(-1).mean(-1))
+
+
+class DiagramIndex:
+    def __init__(self, num_directions=16, resolution=64, num_components=128, num_candidates=64):
+        """
+        Index over stored diagrams for nearest-neighbor search in sliced Wasserstein distance.
+
+        On one direction, the 1D Wasserstein distance between a completed with the diagonal of b and b completed with the diagonal
+        of a is the L1 distance between g_a - g_b, where g_d(x) = #{projections of points of d <= x} - #{projections of their
+        diagonal projections <= x}. Sampling g_d on a grid gives an embedding in which the L1 norm approximates sliced Wasserstein.
+        Embeddings are stored projected on their num_components principal components, queries search them with one batched
+        matrix product (L2 distance) and the best num_candidates are re-ranked with the exact distance.
+
+        Args:
+            num_directions: Number of directions of the slices
+            resolution: Number of grid points of each direction
+            num_components: Dimension of the stored vectors
+            num_candidates: Number of candidates re-ranked with the exact distance
+        """
+        self.directions = _directions(num_directions)
+        self.resolution = resolution
+        self.num_components = num_components
+        self.num_candidates = num_candidates
+        self.lo, self.step = None, None
+        self.mean, self.components = None, None
+        self.diagrams, self.labels, self.vectors = None, None, None
+
+    def __len__(self):
+        return 0 if self.diagrams is None else len(self.diagrams)
+
+    def embed(self, diagrams):
+        """
+        Args:
+            diagrams: DiagramBatch
+        Returns:
+            embedding: Tensor of shape [batch_size, (C*len_dim*num_directions*resolution)]
+        """
+        diagrams = diagrams.to("cpu")
+        points = torch.stack((diagrams.birth, diagrams.death), -1).float()
+        proj, diag_proj = _projections(points, self.directions)     # shape: [n, M]
+        if self.lo is None:     # grid of each direction is fitted to the first diagrams added
+            lo = torch.minimum(proj.min(0)[0], diag_proj.min(0)[0]) if len(points) else torch.zeros(len(self.directions.T))
+            hi = torch.maximum(proj.max(0)[0], diag_proj.max(0)[0]) if len(points) else torch.ones(len(self.directions.T))
+            self.lo, self.step = lo, (hi - lo).clamp(min=1e-6) / (self.resolution - 1)
+
+        M, R = self.directions.shape[1], self.resolution
+        g = torch.zeros(diagrams.num_groups, M, R + 1)
+        direction = torch.arange(M).expand(len(points), M)
+        group = diagrams.group.unsqueeze(-1).expand(-1, M)
+        for proj, sign in ((proj, 1.), (diag_proj, -1.)):
+            bin = torch.ceil((proj - self.lo) / self.step).long().clamp(0, R)     # first grid point at or after the projection
+            g.index_put_((group, direction, bin), torch.full_like(proj, sign), accumulate=True)
+        g = g.cumsum(-1)[..., :R] * (self.step / M).unsqueeze(-1)      # Riemann sum of the mean over directions
+        return g.view(len(diagrams), -1)
+
+    def add(self, diagrams, labels=None):
+        """
+        Args:
+            diagrams: DiagramBatch
+            labels: Tensor of shape [batch_size, ]
+        """
+        diagrams = diagrams.to("cpu").clone()
+        embeddings = self.embed(diagrams)
+        if self.components is None:     # principal components of the first diagrams added
+            self.mean = embeddings.mean(0)
+            q = min(self.num_components, *embeddings.shape)
+            self.components = torch.pca_lowrank(embeddings - self.mean, q=q, center=False)[2]  # shape: [D, q]
+        vectors = (embeddings - self.mean) @ self.components
+        if self.diagrams is None:
+            self.diagrams, self.labels, self.vectors = diagrams, labels, vectors
+        else:
+            self.diagrams = DiagramBatch.cat([self.diagrams, diagrams])
+            self.vectors = torch.cat((self.vectors, vectors))
+            if labels is not None:
+                self.labels = torch.cat((self.labels, labels))
+
+    def distances(self, diagrams, candidates, chunk_size=4096):
+        """
+        Exact sliced Wasserstein distance summed over channels and dimensions.
+
+        Args:
+            diagrams: DiagramBatch of queries
+            candidates: Tensor of shape [Q, c], stored samples to compare with each query
+        Returns:
+            distance: Tensor of shape [Q, c]
+        """
+        diagrams = diagrams.to("cpu")
+        G = diagrams.groups_per_sample
+        Q, c = candidates.shape
+        query_groups = (torch.arange(Q).view(Q, 1, 1) * G + torch.arange(G)).expand(Q, c, G).reshape(-1)
+        stored_groups = (candidates.unsqueeze(-1) * G + torch.arange(G)).reshape(-1)
+        distance = torch.cat([sliced_wasserstein(_padded(diagrams, q).float(), _padded(self.diagrams, s).float(), self.directions)
+                              for q, s in zip(query_groups.split(chunk_size), stored_groups.split(chunk_size))])
+        return distance.view(Q, c, G).sum(-1)
+
+    def search(self, diagrams, k=10):
+        """
+        Args:
+            diagrams: DiagramBatch of queries
+            k: Number of neighbors
+        Returns:
+            distance: Tensor of shape [Q, k], exact sliced Wasserstein distance
+            index: Tensor of shape [Q, k], position of the neighbors in the index
+        """
+        query = (self.embed(diagrams) - self.mean) @ self.components
+        approx = torch.cdist(query, self.vectors, compute_mode="use_mm_for_euclid_dist")   # shape: [Q, N]
+        candidates = approx.topk(min(max(self.num_candidates, k), len(self)), largest=False)[1]
+        distance = self.distances(diagrams, candidates)
+        distance, order = distance.topk(min(k, len(self)), largest=False)
+        return distance, candidates.gather(1, order)
+
+    def predict(self, diagrams, k=5):
+        """
+        Majority vote of the labels of the k nearest neighbors.
+
+        Args:
+            diagrams: DiagramBatch of queries
+            k: Number of neighbors
+        Returns:
+            labels: Tensor of shape [Q, ]
+        """
+        _, index = self.search(diagrams, k)
+        return torch.mode(self.labels[index], 1)[0]
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 
@@ -21,18 +22,19 @@ def make_grid(lims=[[1,28], [1,28]], size=[28, 28]):
     return grid
 
 
-def cal_dist(grid, r=2):
+def cal_dist(grid, r=2, other=None):
     """
     Calculate distance between all cooridnate points on grid.
 
     Args:
         grid: Tensor of shape [(H*W), 2]
         r:
+        other: Tensor of shape [n, 2]. If given, distance from every point of grid to every point of other
     Returns:
-        distance: Tensor of shape [(H*W), (H*W)]
+        distance: Tensor of shape [(H*W), (H*W)] or [(H*W), n]
     """
     X = grid.unsqueeze(1)
-    Y = grid.unsqueeze(0)
+    Y = grid.unsqueeze(0) if other is None else other.unsqueeze(0)
     if r == 2:
         dist = torch.sqrt(torch.sum((X - Y)**2, -1))
     elif r == 1:
@@ -92,6 +94,8 @@ def dtm_using_knn(knn_dist, knn_index, input, bound, r=2):
 
 
 class DTMLayer(nn.Module):
+    MAX_CACHED_SIZES = 4    # neighbor tables kept for sizes other than size, least recently used ones are dropped
+
     def __init__(self, m0=0.05, lims=[[1,28], [1,28]], size=[28, 28], r=2):
         """
         Args:
@@ -102,11 +106,74 @@ class DTMLayer(nn.Module):
             r:
         """
         super().__init__()
-        grid = make_grid(lims, size)    # shape: [(H*W), 2]
-        self.dist = cal_dist(grid)
+        self.lims = [[float(start), float(end)] for start, end in lims]
+        self.size = list(size)
         self.m0 = m0
         self.r = r
         self.flatten = nn.Flatten(start_dim=-2)
+        self._dist = None
+        self._neighbors = OrderedDict()     # (H, W) -> (knn_dist, knn_index) of the nearest grid points, built on first use
+
+    @property
+    def dist(self):
+        """
+        Returns:
+            dist: Tensor of shape [(H*W), (H*W)], distance between grid points, built on first access
+        """
+        if self._dist is None:
+            grid = make_grid(self.lims, self.size)  # shape: [(H*W), 2]
+            self._dist = cal_dist(grid)
+        return self._dist
+
+    def grid_lims(self, size):
+        """
+        Domain of the grid of images of another size: grid points keep the spacing of lims and size, so that DTM values
+        (and the filtration range of the topology layers) have the same scale for all sizes.
+
+        Args:
+            size: list or tuple in the form of [H, W]
+        Returns:
+            lims: list in the form of [[domain of H], [domain of W]]
+        """
+        return [[start, start + (end - start) * (n - 1) / max(default - 1, 1)]
+                for (start, end), default, n in zip(self.lims, self.size, size)]
+
+    def neighbors(self, device="cpu", size=None, k=None):
+        """
+        The k nearest grid points of each grid point in order of distance, so that the nearest neighbors of any smaller k
+        are a slice. Kept per image size and only rebuilt when a larger k is asked for, then with at least twice the
+        columns. Rows are computed in chunks, so the distance matrix of all grid points is never held. Besides the table of
+        size, only the MAX_CACHED_SIZES most recently used ones are kept.
+
+        Args:
+            size: [H, W], self.size if None
+            k: Number of neighbors needed, the table kept (all grid points if none) if None
+        Returns:
+            knn_dist: Tensor of shape [(H*W), k'] with k' >= k
+            knn_index: Tensor of shape [(H*W), k']
+        """
+        size = tuple(self.size if size is None else size)
+        HW = size[0] * size[1]
+        cached = self._neighbors.get(size)
+        if cached is None or (k is not None and cached[0].shape[1] < k):
+            k = HW if k is None else min(HW, max(k, 2 * cached[0].shape[1] if cached is not None else k))
+            grid = make_grid(self.lims if size == tuple(self.size) else self.grid_lims(size), size)    # shape: [(H*W), 2]
+            chunks = [cal_dist(grid[i:i+1024], other=grid).topk(k, -1, largest=False) for i in range(0, HW, 1024)]
+            cached = tuple(torch.cat(x) for x in zip(*chunks))
+        if cached[0].device != torch.device(device):
+            cached = tuple(x.to(device) for x in cached)
+        self._neighbors[size] = cached
+        self._neighbors.move_to_end(size)
+        others = [s for s in self._neighbors if s != tuple(self.size)]
+        for s in others[:max(len(others) - self.MAX_CACHED_SIZES, 0)]:
+            del self._neighbors[s]
+        return cached
+
+    def set_neighbors(self, knn_dist, knn_index, size=None):
+        """
+        Sets the geometry computed by neighbors (e.g. loaded from an exported model) instead of building it.
+        """
+        self._neighbors[tuple(self.size if size is None else size)] = (knn_dist, knn_index)
         
     def forward(self, input):
         """
@@ -127,8 +194,8 @@ class DTMLayer(nn.Module):
             if max_k > weight.shape[-1]:    # when max_k is out of range (max_k > H*W)
                 max_k = weight.shape[-1]
 
-        self.dist = self.dist.to(weight.device)
-        knn_dist, knn_index = self.dist.topk(max_k, largest=False, dim=-1)  # shape: [(H*W), max_k]
+        knn_dist, knn_index = self.neighbors(weight.device, input.shape[-2:], max_k)
+        knn_dist, knn_index = knn_dist[:, :max_k], knn_index[:, :max_k]     # shape: [(H*W), max_k]
         dtm_val = dtm_using_knn(knn_dist, knn_index, weight, bound, self.r) # shape: [batch_size, C, (H*W)]
         # if self.scale_dtm:
         #     dtm_val = dtm_val * (weight.max(dim=-1, keepdim=True).values / dtm_val.max(dim=-1, keepdim=True).values)  # Think about multiplying weight.max
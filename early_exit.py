@@ -0,0 +1,155 @@
+import json
+import time
+import argparse
+import importlib
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset, DataLoader
+from torch.optim import Adam
+from train_test import CustomDataset
+from export import export
+
+
+def _predict(model, x, batch_size=64, device="cpu"):
+    """
+    Returns:
+        exit_output: Tensor of shape [N, num_classes], logits of exit_layer
+        output: Tensor of shape [N, num_classes], logits of the full model
+        seconds: Time spent in the full model
+    """
+    threshold = model.exit_threshold.clone()
+    model.exit_threshold.fill_(float("inf"))
+    model.eval()
+    exit_list, output_list, seconds = [], [], 0
+    try:
+        with torch.no_grad():
+            for i in range(0, len(x), batch_size):
+                X = x[i:i+batch_size].float().to(device)
+                exit_list.append(model.exit_layer(model._cnn_branch(X)).cpu())
+                start = time.perf_counter()
+                output_list.append(model(X).cpu())
+                seconds += time.perf_counter() - start
+    finally:
+        model.exit_threshold.copy_(threshold)
+    return torch.concat(exit_list), torch.concat(output_list), seconds
+
+
+def train_exit_layer(model, x, y, epochs=20, batch_size=64, lr=1e-3, device="cpu"):
+    """
+    Trains exit_layer on the features of the CNN/ResNet branch of a trained model, which stays frozen. The features are
+    computed once, no topology branch is run.
+
+    Args:
+        model: EC_CNN_2, PL_CNN_2 or EClayResNet built with early_exit=True
+        x: Tensor of shape [N, C, H, W]
+        y: Tensor of shape [N, ]
+    """
+    model.eval()
+    with torch.no_grad():
+        features = torch.concat([model._cnn_branch(x[i:i+256].float().to(device)).cpu() for i in range(0, len(x), 256)])
+    dataloader = DataLoader(TensorDataset(features, y), batch_size, shuffle=True)
+    optimizer = Adam(model.exit_layer.parameters(), lr)
+    loss_fn = nn.CrossEntropyLoss()
+    for epoch in range(1, epochs + 1):
+        ma_loss, correct = 0, 0
+        for X, Y in dataloader:
+            X, Y = X.to(device), Y.to(device)
+            y_pred = model.exit_layer(X)
+            loss = loss_fn(y_pred, Y)
+            ma_loss += loss.item() * len(Y)
+            correct += (y_pred.argmax(1) == Y).sum().item()
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        print(f"Epoch {epoch}: exit layer accuracy: {100 * correct / len(y):>0.1f}%, avg loss: {ma_loss / len(y):>8f}")
+
+
+def calibrate(model, x, y, target_accuracy=None, max_drop=0.5, batch_size=64, device="cpu"):
+    """
+    Sets model.exit_threshold to the lowest confidence that keeps the accuracy on (x, y) at least target_accuracy, i.e.
+    lets as many samples as possible skip the topology branches.
+
+    Args:
+        model: EC_CNN_2, PL_CNN_2 or EClayResNet with a trained exit_layer
+        x: Tensor of shape [N, C, H, W], held out from the training of exit_layer
+        y: Tensor of shape [N, ]
+        target_accuracy: Accuracy (%) to keep. If None, accuracy of the full model minus max_drop
+        max_drop: Accuracy (%p) that may be lost compared to the full model
+    Returns:
+        result: dict of threshold, exit_rate (%), accuracy (%) and full_accuracy (%) on (x, y)
+    """
+    exit_output, output, _ = _predict(model, x, batch_size, device)
+    confidence = exit_output.softmax(-1).amax(-1)
+    exit_correct = (exit_output.argmax(-1) == y).float()
+    full_correct = (output.argmax(-1) == y).float()
+    full_accuracy = 100 * full_correct.mean().item()
+    target_accuracy = full_accuracy - max_drop if target_accuracy is None else target_accuracy
+
+    # the k most confident samples exit
+    confidence, order = confidence.sort(descending=True)
+    gain = torch.concat((torch.zeros(1), (exit_correct[order] - full_correct[order]).cumsum(0)))
+    accuracy = 100 * (full_correct.sum() + gain) / len(y)   # shape: [N+1, ], accuracy when k samples exit
+    feasible = (accuracy >= target_accuracy - 1e-9).nonzero().squeeze(1)
+    k = int(feasible.max()) if len(feasible) > 0 else 0
+    threshold = confidence[k-1].item() if k > 0 else float("inf")
+    model.exit_threshold.fill_(threshold)
+
+    print(f"{'threshold':>10s} {'exit rate':>10s} {'accuracy':>9s}")
+    for t in sorted({0.5, 0.7, 0.9, 0.95, 0.99, 0.999, threshold}):
+        exits = (confidence >= t).sum().item()
+        print(f"{t:>10.4f} {100 * exits / len(y):>9.1f}% {accuracy[exits].item():>8.1f}%" + (" <-" if t == threshold else ""))
+    result = {"threshold": threshold, "exit_rate": 100 * k / len(y), "accuracy": accuracy[k].item(), "full_accuracy": full_accuracy}
+    print(f"Full model accuracy: {full_accuracy:>0.1f}%, target: {target_accuracy:>0.1f}%, "
+          f"threshold: {threshold:>0.4f}, exit rate: {result['exit_rate']:>0.1f}%")
+    return result
+
+
+def report(model, x, y, batch_size=64, device="cpu"):
+    """
+    Accuracy and throughput of the full model and of early exit at model.exit_threshold.
+    """
+    _, output, full_seconds = _predict(model, x, batch_size, device)
+    correct, exits, seconds = 0, 0, 0
+    with torch.no_grad():
+        for i in range(0, len(x), batch_size):
+            X, Y = x[i:i+batch_size].float().to(device), y[i:i+batch_size].to(device)
+            start = time.perf_counter()
+            y_pred = model(X)
+            seconds += time.perf_counter() - start
+            correct += (y_pred.argmax(1) == Y).sum().item()
+            exits += (model.exit_layer(model._cnn_branch(X)).softmax(-1).amax(-1) >= model.exit_threshold).sum().item()
+    print(f"Full model: accuracy {100 * (output.argmax(-1) == y).float().mean().item():>0.1f}%, {len(y) / full_seconds:>0.1f} images/s")
+    print(f"Early exit: accuracy {100 * correct / len(y):>0.1f}%, {len(y) / seconds:>0.1f} images/s, exit rate {100 * exits / len(y):>0.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="model class, e.g. models.EC_CNN_2")
+    parser.add_argument("weights", help="trained weights, e.g. MNIST/saved_weights/ECCNN_MNIST/00_00/sim1.pt")
+    parser.add_argument("x_path", help="generated data, e.g. MNIST/generated_data/x_00_00.pt")
+    parser.add_argument("y_path", help="labels, e.g. MNIST/generated_data/y.pt")
+    parser.add_argument("output", help="file of the exported model with early exit, see export.py")
+    parser.add_argument("--params", default="{}", help="arguments of the model as json, same as model_params of the train script")
+    parser.add_argument("--target", type=float, help="accuracy (%%) to keep on the validation split")
+    parser.add_argument("--max-drop", type=float, default=0.5, help="accuracy (%%p) that may be lost if no target is given")
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--seed", type=int, default=123, help="seed of the train/validation split")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    module_name, class_name = args.model.rsplit(".", 1)
+    model_params = {**json.loads(args.params), "early_exit": True}
+    model = getattr(importlib.import_module(module_name), class_name)(**model_params).to(args.device)
+    missing, unexpected = model.load_state_dict(torch.load(args.weights, map_location=args.device), strict=False)
+    assert not unexpected and all(k.startswith("exit_") for k in missing), f"{args.weights} doesn't match {args.model}"
+
+    train_dataset = CustomDataset(args.x_path, args.y_path, "train", seed=args.seed)
+    val_dataset = CustomDataset(args.x_path, args.y_path, "val", seed=args.seed)
+    test_dataset = CustomDataset(args.x_path, args.y_path, "test")
+    if missing:
+        train_exit_layer(model, train_dataset.x_tr, train_dataset.y_tr, args.epochs, args.batch_size, args.lr, args.device)
+    calibrate(model, val_dataset.x_val, val_dataset.y_val, args.target, args.max_drop, args.batch_size, args.device)
+    report(model, test_dataset.x_test, test_dataset.y_test, args.batch_size, args.device)
+    export(model, model_params, args.output)
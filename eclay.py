@@ -1,12 +1,13 @@
 import torch
 import torch.nn as nn
 import numpy as np
-import gudhi
-from torch_topological.nn import CubicalComplex
+from persistence import BACKENDS
+from diagram import DiagramBatch
+from scheduler import to_host, to_device
 
     
 class EC_Layer(nn.Module):
-    def __init__(self, superlevel=False, start=0, end=7, T=32, num_channels=1):
+    def __init__(self, superlevel=False, start=0, end=7, T=32, num_channels=1, backend="gudhi"):
         """
         Args:
             superlevel: Whether to calculate topological features based on superlevel sets. If set to False, uses sublevels sets
@@ -14,37 +15,237 @@ class EC_Layer(nn.Module):
             end: Max value of domain
             T: How many discretized points to use
             num_channels: Number of channels in input
+            backend: Persistence backend, one of "gudhi", "grid" or "quantized"
         """
         super().__init__()
-        self.cub_cpx = CubicalComplex(superlevel, dim=2)
+        self.superlevel = superlevel
+        self.backend = backend
+        # levels on the grid of tseq keep the EC exact (see quantized_persistence)
+        self.backend_kwargs = {"step": (end - start) / (T - 1), "offset": start} if backend == "quantized" else {}
         self.T = T
+        self.end = end
         self.tseq = torch.linspace(start, end, T).unsqueeze(0)  # shape: [1, T]
         self.num_channels = num_channels
 
     def forward(self, input):
+        """
+        Args:
+            input: Tensor of shape [batch_size, C, H, W], DiagramBatch with dimensions [0, 1] or ECJumps
+        Returns:
+            ec: Tensor of shape [batch_size, C, T]
+        """
+        if isinstance(input, ECJumps):
+            return input.resample(self.tseq.to(input.threshold.device))
+        input_device = input.birth.device if isinstance(input, DiagramBatch) else input.device
+        diagrams = self.diagrams(input)
+        batch_size = len(diagrams)
+
+        alive = torch.logical_and(diagrams.birth.unsqueeze(-1) < self.tseq, diagrams.death.unsqueeze(-1) >= self.tseq)  # shape: [num_ph, T]
+        betti = torch.zeros(batch_size * self.num_channels * 2, self.T).index_add_(0, diagrams.group, alive.float())
+        betti = betti.view(batch_size, self.num_channels, 2, self.T)
+        ec = betti[:, :, 0, :] - betti[:, :, 1, :]
+        return to_device(ec, input_device)
+
+    def diagrams(self, input):
+        """
+        Args:
+            input: Tensor of shape [batch_size, C, H, W] or DiagramBatch with dimensions [0, 1]
+        Returns:
+            diagrams: DiagramBatch on cpu, truncated at end
+        """
+        if isinstance(input, DiagramBatch):
+            assert input.dimensions == [0, 1]
+            return input.to("cpu")
+        if input.device.type != "cpu":
+            input = to_host(input)  # bc. calculation of persistence diagram is much faster on cpu
+        # betti numbers on [start, end] don't depend on anything that enters after end
+        return BACKENDS[self.backend](input, self.superlevel, dimensions=[0, 1], cutoff=self.end, **self.backend_kwargs)  # points grouped in order of batch_size, channel and dimension
+
+
+def ec_linear(diagrams, tseq, weight, bias=None):
+    """
+    Same as nn.functional.linear applied to the flattened output of EC_Layer, computed straight from the diagrams.
+    A point adds its sign to the EC at every t with birth < t <= death, i.e. at a contiguous range [lo, hi) of tseq,
+    so it contributes the difference of two columns of the prefix sums of the weight. The cost per point doesn't depend on T.
+
+    Args:
+        diagrams: DiagramBatch with dimensions [0, 1]
+        tseq: Tensor of shape [1, T]
+        weight: Tensor of shape [out_features, (C*T)]
+        bias: Tensor of shape [out_features, ]
+    Returns:
+        output: Tensor of shape [batch_size, out_features]
+    """
+    device, C = weight.device, diagrams.num_channels
+    tseq = tseq.reshape(-1).to(device)
+    diagrams = diagrams.to(device)
+    out_features, T = weight.shape[0], len(tseq)
+    prefix = torch.cat((weight.new_zeros(out_features, C, 1), weight.view(out_features, C, T).cumsum(-1)), -1)   # shape: [out_features, C, T+1]
+
+    group = diagrams.group
+    sample, channel, sign = group // (2*C), (group // 2) % C, 1 - 2 * (group % 2)
+    lo = torch.searchsorted(tseq, diagrams.birth.to(tseq.dtype), right=True)   # number of t <= birth
+    hi = torch.searchsorted(tseq, diagrams.death.to(tseq.dtype), right=True)
+    contribution = (prefix[:, channel, hi] - prefix[:, channel, lo]) * sign     # shape: [out_features, num_ph]
+    output = weight.new_zeros(len(diagrams), out_features).index_add_(0, sample, contribution.T)
+    return output if bias is None else output + bias
+
+
+class ECJumps:
+    def __init__(self, threshold, delta, offsets, num_channels):
+        """
+        Exact EC curves of a batch of images stored as jump points (CSR layout), EC(t) = sum of delta over jumps with threshold < t.
+        Curves are in order of batch_size and channel, and the jumps of curve g are sorted by threshold and lie in
+        threshold[offsets[g]-offsets[0]:offsets[g+1]-offsets[0]]. The curves can be resampled on any grid later.
+
+        Args:
+            threshold: Tensor of shape [n, ]
+            delta: Tensor of shape [n, ], change of EC right after threshold
+            offsets: Tensor of shape [(batch_size*C) + 1]
+            num_channels: Number of channels of the images
+        """
+        self.threshold = threshold
+        self.delta = delta
+        self.offsets = offsets
+        self.num_channels = num_channels
+
+    @classmethod
+    def from_diagrams(cls, diagrams):
+        """
+        Args:
+            diagrams: DiagramBatch with dimensions [0, 1]. Deaths truncated at a cutoff make the curves valid only up to the cutoff
+        """
+        assert diagrams.dimensions == [0, 1]
+        diagrams = diagrams.to("cpu")
+        group = diagrams.group
+        curve, sign = group // 2, 1 - 2 * (group % 2).int()    # H0 counts positive, H1 negative
+        return cls._merge(torch.cat((curve, curve)), torch.cat((diagrams.birth, diagrams.death)), torch.cat((sign, -sign)),
+                          diagrams.num_groups // 2, diagrams.num_channels)
+
+    @classmethod
+    def from_input(cls, input, superlevel=False, backend="gudhi"):
         """
         Args:
             input: Tensor of shape [batch_size, C, H, W]
+            superlevel: Whether to calculate topological features based on superlevel sets. If set to False, uses sublevels sets.
+                        Thresholds are then in the negated domain, same as tseq of EC_Layer
+            backend: Persistence backend, one of "gudhi", "grid" or "quantized"
+        """
+        return cls.from_diagrams(BACKENDS[backend](input.cpu(), superlevel, dimensions=[0, 1]))
+
+    @classmethod
+    def _merge(cls, curve, threshold, delta, num_curves, num_channels):
+        """
+        Sorts jumps by curve and threshold, sums jumps at the same threshold and drops the ones that cancel.
+        """
+        order = torch.argsort(threshold, stable=True)
+        order = order[torch.argsort(curve[order], stable=True)]
+        curve, threshold, delta = curve[order], threshold[order], delta[order]
+        first = torch.ones(len(curve), dtype=torch.bool)
+        first[1:] = (curve[1:] != curve[:-1]) | (threshold[1:] != threshold[:-1])
+        run = torch.cumsum(first, 0) - 1
+        delta = torch.zeros(int(first.sum()), dtype=delta.dtype).index_add_(0, run, delta)
+        curve, threshold = curve[first], threshold[first]
+        keep = delta != 0
+        counts = torch.bincount(curve[keep], minlength=num_curves)
+        offsets = torch.zeros(num_curves + 1, dtype=torch.long)
+        offsets[1:] = counts.cumsum(0)
+        return cls(threshold[keep], delta[keep], offsets, num_channels)
+
+    @property
+    def num_curves(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        return self.offsets.diff()
+
+    @property
+    def curve(self):
+        """
+        Curve that each jump belongs to, shape: [n, ]
+        """
+        return torch.repeat_interleave(torch.arange(self.num_curves, device=self.offsets.device), self.counts)
+
+    def __len__(self):
+        return self.num_curves // self.num_channels
+
+    def __getitem__(self, ind):
+        """
+        Zero-copy slicing over samples.
+        """
+        if isinstance(ind, int):
+            ind = slice(ind, ind + 1) if ind != -1 else slice(ind, None)
+        start, stop, step = ind.indices(len(self))
+        assert step == 1, "only contiguous slices are supported"
+        offsets = self.offsets[start*self.num_channels:stop*self.num_channels + 1]
+        lo, hi = offsets[0] - self.offsets[0], offsets[-1] - self.offsets[0]
+        return ECJumps(self.threshold[lo:hi], self.delta[lo:hi], offsets, self.num_channels)
+
+    def resample(self, tseq):
+        """
+        Args:
+            tseq: Tensor of shape [T, ] or [1, T]
         Returns:
             ec: Tensor of shape [batch_size, C, T]
         """
-        batch_size = input.shape[0]
-        input_device = input.device
-        if input_device.type != "cpu":
-            input = input.cpu()     # bc. calculation of persistence diagram is much faster on cpu
-        
-        ec = torch.zeros(batch_size, self.num_channels, self.T)
-        pi_list = self.cub_cpx(input)   # lists nested in order of batch_size, channel and dimension
-        for b in range(batch_size):
-            for c in range(self.num_channels):
-                # pd_0 = pi_list[b][c][0].diagram[:-1]    ##################### test w. & w.o. remove last row (min, inf.)
-                pd_0 = pi_list[b][c][0].diagram
-                pd_1 = pi_list[b][c][1].diagram
-                betti_0 = torch.logical_and(pd_0[:, [0]] < self.tseq, pd_0[:, [1]] >= self.tseq).sum(dim=0)
-                betti_1 = torch.logical_and(pd_1[:, [0]] < self.tseq, pd_1[:, [1]] >= self.tseq).sum(dim=0)
-                ec[b, c, :] = betti_0 - betti_1
-        return ec if input_device == "cpu" else ec.to(input_device)
-    
+        tseq = tseq.reshape(-1)
+        counts = self.counts
+        length = max(int(counts.max()) if self.num_curves else 0, 1)
+        curve = self.curve
+        pos = torch.arange(len(curve), device=curve.device) - (self.offsets[:-1] - self.offsets[0]).repeat_interleave(counts)
+        padded = torch.full((self.num_curves, length), float("inf"), dtype=self.threshold.dtype, device=curve.device)
+        padded[curve, pos] = self.threshold
+        level = torch.zeros(self.num_curves, length + 1, dtype=self.delta.dtype, device=curve.device)
+        level[curve, pos + 1] = self.delta
+        level = level.cumsum(1)     # EC after each jump, shape: [num_curves, length+1]
+        below = torch.searchsorted(padded, tseq.to(padded.dtype).expand(self.num_curves, -1).contiguous())    # number of jumps with threshold < t
+        ec = level.gather(1, below).float()
+        return ec.view(len(self), self.num_channels, len(tseq))
+
+    def integrate(self, start, end):
+        """
+        Args:
+            start: Lower limit of integration
+            end: Upper limit of integration
+        Returns:
+            integral: Tensor of shape [batch_size, C], integral of EC over [start, end]
+        """
+        length = end - self.threshold.clamp(start, end)     # each jump adds delta on (threshold, end]
+        integral = torch.zeros(self.num_curves, dtype=length.dtype, device=length.device).index_add_(0, self.curve, self.delta * length)
+        return integral.view(len(self), self.num_channels)
+
+    def __add__(self, other):
+        assert self.num_curves == other.num_curves
+        return ECJumps._merge(torch.cat((self.curve, other.curve)), torch.cat((self.threshold, other.threshold)),
+                              torch.cat((self.delta, other.delta)), self.num_curves, self.num_channels)
+
+    def __neg__(self):
+        return ECJumps(self.threshold, -self.delta, self.offsets, self.num_channels)
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __mul__(self, scalar):
+        if scalar == 0:
+            return ECJumps._merge(self.curve, self.threshold, self.delta * 0, self.num_curves, self.num_channels)
+        return ECJumps(self.threshold, self.delta * scalar, self.offsets, self.num_channels)
+
+    __rmul__ = __mul__
+
+    def to(self, *args, **kwargs):
+        return ECJumps(self.threshold.to(*args, **kwargs), self.delta.to(*args, **kwargs),
+                       self.offsets.to(*args, **kwargs), self.num_channels)
+
+    def save(self, path):
+        offsets = self.offsets - self.offsets[0]
+        torch.save({"threshold": self.threshold.clone(), "delta": self.delta.clone(),
+                    "offsets": offsets, "num_channels": self.num_channels}, path)
+
+    @classmethod
+    def load(cls, path, map_location="cpu"):
+        return cls(**torch.load(path, map_location=map_location))
+
 
 # class EC_Layer2(nn.Module):
 #     def __init__(self, T=50):
@@ -69,7 +270,7 @@ class EC_Layer(nn.Module):
     
 
 class EC_TopoLayer(nn.Module):
-    def __init__(self, superlevel=False, start=0, end=7, T=32, num_channels=1, hidden_features=[64, 32]):
+    def __init__(self, superlevel=False, start=0, end=7, T=32, num_channels=1, hidden_features=[64, 32], backend="gudhi", fused=False):
         """
         Args:
             superlevel: 
@@ -78,9 +279,12 @@ class EC_TopoLayer(nn.Module):
             T: How many discretized points to use
             num_channels: Number of channels in input
             hidden_features: List containing the dimension of fc layers
+            backend: Persistence backend, one of "gudhi", "grid" or "quantized"
+            fused: Whether to apply the first fc layer straight to the diagrams (see ec_linear) instead of the EC curves
         """
         super().__init__()
-        self.ec_layer = EC_Layer(superlevel, start, end, T, num_channels)
+        self.fused = fused
+        self.ec_layer = EC_Layer(superlevel, start, end, T, num_channels, backend)
         self.flatten = nn.Flatten()
         self.gtheta_layer = self._make_gtheta_layer(num_channels * T, hidden_features)
 
@@ -92,7 +296,21 @@ class EC_TopoLayer(nn.Module):
         Returns:
             output: Tensor of shape [batch_size, out_features]
         """
+        if self.fused and not isinstance(input, ECJumps):
+            first = self.gtheta_layer[0]
+            output = ec_linear(self.ec_layer.diagrams(input), self.ec_layer.tseq, first.weight, first.bias)
+            return self.gtheta_layer[1:](output)
         ec = self.ec_layer(input)
+        return self.head(ec)
+
+    def head(self, ec):
+        """
+        Args:
+            ec: Tensor of shape [batch_size, num_channels, T], output of ec_layer
+
+        Returns:
+            output: Tensor of shape [batch_size, out_features]
+        """
         ec = self.flatten(ec)   # shape: [batch_size, (num_channels * T)]
         output = self.gtheta_layer(ec)
         return output
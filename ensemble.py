@@ -0,0 +1,85 @@
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+from cache import FeatureCache
+
+
+class _SharedFeatures:
+    def __init__(self):
+        """
+        Stand-in for the feature_cache of the models. In "record" mode the parameter-free part of each topology branch is
+        computed and kept, in "replay" mode the kept features are returned, so that they are computed once for all members.
+        """
+        self.mode = "record"
+        self.features = {}      # vectorization module -> Tensor
+
+    def __call__(self, input, branch):
+        if self.mode == "record":
+            with torch.no_grad():
+                self.features[branch[-1]] = FeatureCache._apply(branch, input)
+        return self.features[branch[-1]]
+
+
+class Ensemble(nn.Module):
+    def __init__(self, MODEL, model_params, weight_paths, device="cpu"):
+        """
+        Members of the same configuration (e.g. the sim{n}.pt of the simulations) evaluated together. Topological features
+        (DTM followed by EC_Layer or PL_Layer) have no parameters and are computed once per batch by the first member, whose
+        output is kept. Only the learnable parts of the other members are run, stacked with torch.func.vmap where the model
+        allows it.
+
+        Args:
+            MODEL: Model class
+            model_params: dict of arguments of MODEL
+            weight_paths: list of files with the state_dict of each member
+            device: Device of the members
+        """
+        super().__init__()
+        members = []
+        for path in weight_paths:
+            model = MODEL(**model_params).to(device)
+            model.load_state_dict(torch.load(path, map_location=device))
+            if getattr(model, "exit_layer", None) is not None:
+                # early exit runs the topology branches on a different subset per member, which neither vmap nor the
+                # shared features allow, so members run the full model
+                model.exit_layer = None
+            members.append(model.eval())
+        self.num_members = len(members)
+        self.base = members[0]
+        self.shared = _SharedFeatures()
+        if hasattr(self.base, "feature_cache"):
+            self.base.feature_cache = self.shared
+        if hasattr(self.base, "frozen_cache"):
+            self.base.frozen_cache = None
+        self.params, self.buffers = stack_module_state(members[1:]) if len(members) > 1 else ({}, {})
+        self.vectorized = True
+
+    def _member(self, params, buffers, input):
+        return functional_call(self.base, (params, buffers), (input,))
+
+    def forward(self, input):
+        """
+        Args:
+            input: Tensor of shape [batch_size, C, H, W]
+        Returns:
+            output: Tensor of shape [num_members, batch_size, num_classes]
+        """
+        self.shared.mode, self.shared.features = "record", {}
+        with torch.no_grad():
+            first = self.base(input)
+        self.shared.mode = "replay"
+        if self.num_members == 1:
+            return first.unsqueeze(0)
+        if self.vectorized:
+            concurrent = getattr(self.base, "concurrent", False)
+            self.base.concurrent = False    # vmap doesn't reach into worker threads
+            try:
+                others = vmap(self._member, in_dims=(0, 0, None))(self.params, self.buffers, input)
+                return torch.cat((first.unsqueeze(0), others))
+            except RuntimeError:    # operation without batching rule, run the members one after the other
+                self.vectorized = False
+            finally:
+                self.base.concurrent = concurrent
+        others = [self._member({k: v[i] for k, v in self.params.items()},
+                               {k: v[i] for k, v in self.buffers.items()}, input) for i in range(self.num_members - 1)]
+        return torch.stack([first] + others)
@@ -0,0 +1,89 @@
+import json
+import inspect
+import argparse
+import importlib
+import torch
+from dtm import DTMLayer
+
+
+FORMAT_VERSION = 1
+
+
+def export(model, model_params, path, example_input=None, batch_size=256):
+    """
+    Packs a trained model into one file: its class, the arguments to build it (which hold the DTM and vectorization
+    configuration), its state_dict and the nearest neighbors of every DTM grid, so that loading needs neither the
+    geometry nor the initialization of the layers to be computed. See load_exported.
+
+    Neighbor tables are written as forward has built them, i.e. with as many neighbors as the inputs seen so far needed.
+    Tables of grids never used are written in full. Loaded tables grow on first use if an input needs more neighbors.
+
+    Args:
+        model: Trained model, e.g. EC_CNN_2 with the weights of sim1.pt
+        model_params: dict of arguments of the class of model
+        path: Output file
+        example_input: Tensor of shape [N, C, H, W]. If given, model is run on it first so that the tables fit this data
+        batch_size: Number of images of example_input per forward
+    """
+    if example_input is not None:
+        model.eval()
+        with torch.no_grad():
+            for i in range(0, len(example_input), batch_size):
+                model(example_input[i:i+batch_size].float())
+    geometry, dtm_geometry = {}, {}
+    for name, m in model.named_modules():
+        if isinstance(m, DTMLayer):
+            key = json.dumps([m.lims, m.size])    # DTM layers with the same grid share one table, the one with most neighbors
+            knn_dist, knn_index = m.neighbors()
+            if key not in geometry or geometry[key][0].shape[1] < knn_dist.shape[1]:
+                geometry[key] = (knn_dist.cpu(), knn_index.cpu())
+            dtm_geometry[name] = key
+    torch.save({"format": FORMAT_VERSION,
+                "model": f"{type(model).__module__}.{type(model).__qualname__}",
+                "model_params": model_params,
+                "state_dict": {k: v.cpu() for k, v in model.state_dict().items()},
+                "geometry": geometry,
+                "dtm_geometry": dtm_geometry}, path)
+
+
+def load_exported(path, device="cpu"):
+    """
+    Args:
+        path: File written by export
+        device: Device of the model
+    Returns:
+        model: model in eval mode. On cpu, weights and geometry stay memory-mapped from path and are read on first use
+    """
+    try:
+        artifact = torch.load(path, map_location="cpu", mmap=True)
+    except TypeError:   # torch < 2.1
+        artifact = torch.load(path, map_location="cpu")
+    assert artifact["format"] == FORMAT_VERSION, f"unsupported export format {artifact['format']}"
+    module_name, class_name = artifact["model"].rsplit(".", 1)
+    MODEL = getattr(importlib.import_module(module_name), class_name)
+    model = MODEL(**artifact["model_params"])
+    if "assign" in inspect.signature(model.load_state_dict).parameters:
+        model.load_state_dict(artifact["state_dict"], assign=True)      # keeps the memory-mapped tensors instead of copying
+    else:
+        model.load_state_dict(artifact["state_dict"])
+    for name, key in artifact["dtm_geometry"].items():
+        model.get_submodule(name).set_neighbors(*artifact["geometry"][key])
+    return model.to(device).eval()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="model class, e.g. models.EC_CNN_2 or models_base.EClay")
+    parser.add_argument("weights", help="trained weights, e.g. MNIST/saved_weights/ECCNN_MNIST/00_00/sim1.pt")
+    parser.add_argument("output", help="file of the exported model")
+    parser.add_argument("--params", default="{}", help="arguments of the model as json, same as model_params of the train script")
+    parser.add_argument("--x-path", help="generated data, e.g. MNIST/generated_data/x_00_00.pt. The model is run on its train split "
+                                         "so that only as many neighbors as this data needs are written")
+    args = parser.parse_args()
+
+    module_name, class_name = args.model.rsplit(".", 1)
+    model_params = json.loads(args.params)
+    model = getattr(importlib.import_module(module_name), class_name)(**model_params)
+    model.load_state_dict(torch.load(args.weights, map_location="cpu"))
+    x_train = None if args.x_path is None else torch.load(args.x_path)[0]
+    export(model, model_params, args.output, x_train)
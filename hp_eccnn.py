@@ -38,6 +38,8 @@ sweep_config = {
                 in_channels={"value": 1},
                 num_classes={"value": 10},
                 use_dtm={"value": True},
+                # topology is computed once for all trials on this machine
+                feature_cache={"value": {"shared_dir": f"{args.data}/topo_cache"}},
                 # DTM parameters
                 m0_1={"value": 0.05},
                 m0_2={"value": 0.2},
@@ -34,6 +34,8 @@ sweep_config = {
             "parameters": {
                 "num_classes": {"value": 10},
                 "use_dtm": {"value": True},
+                # topology is computed once for all trials on this machine
+                "feature_cache": {"value": {"shared_dir": f"{args.data}/topo_cache"}},
                 # DTM parameters
                 "m0": {"value": 0.05},
                 "lims": {"value": [[1,28], [1,28]]},
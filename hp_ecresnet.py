@@ -44,6 +44,8 @@ sweep_config = {
                 # "freeze_res": {"value": True},
                 # DTM parameters
                 "use_dtm": {"value": True},
+                # topology is computed once for all trials on this machine
+                "feature_cache": {"value": {"shared_dir": f"{args.data}/topo_cache"}},
                 "m0_1": {"value": 0.05},
                 "m0_2": {"value": 0.2},
                 "lims": {"value": [[1,28], [1,28]]},
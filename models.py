@@ -3,9 +3,33 @@ import torch.nn as nn
 import numpy as np
 from dtm import DTMLayer
 from eclay import EC_TopoLayer
+from cache import topo_branch, make_cache
+from scheduler import run_branches
 from pllay import PL_TopoLayer
 
 
+def early_exit(model, input):
+    """
+    Adaptive-compute forward of the hybrid models: samples on which exit_layer (a classifier on the CNN/ResNet features)
+    is confident enough take its prediction, only the others go through DTM, persistence and the full classifier.
+
+    Args:
+        model: EC_CNN_2, PL_CNN_2 or EClayResNet built with early_exit=True
+        input: Tensor of shape [batch_size, C, H, W]
+    Returns:
+        output: Tensor of shape [batch_size, num_classes], logits of exit_layer for samples with max probability of at
+                least model.exit_threshold and logits of the full model for the others
+    """
+    x_1 = model._cnn_branch(input)
+    output = model.exit_layer(x_1)
+    hard = (output.softmax(-1).amax(-1) < model.exit_threshold).nonzero().squeeze(1)   # shape: [num_hard, ]
+    if len(hard) > 0:
+        x = input[hard]
+        topo = run_branches(x, *model._topo_branches(), concurrent=model.concurrent)
+        output = output.index_put((hard,), model._classify(x_1[hard], *topo))
+    return output
+
+
 class ResidualBlock(nn.Module):
     expansion = 1
 
@@ -120,14 +144,32 @@ class EClayResNet(ResNet):
                  start=0, end=7, T=32, num_channels=1, hidden_features=[64, 32],                                    # EC params
                  start_2=1, end_2=8,                                                                                # EC params 2
                  load_ec=False, ec_path="./MNIST/saved_weights/EClay_MNIST/00_00/sim1.pt", freeze_ec=True,          # loading pretrained eclay
-                 use_dtm=True, m0_1=0.05, m0_2=0.2, **kwargs): # dtm params
+                 use_dtm=True, m0_1=0.05, m0_2=0.2, feature_cache=None, frozen_cache=None, concurrent=True,        # dtm params
+                 early_exit=False, **kwargs):
+        """
+        Args:
+            feature_cache: FeatureCache or dict of its arguments. If given, features before gtheta_layer are cached per sample
+            frozen_cache: FeatureCache, dict of its arguments (e.g. {"backend": "memmap", "spill_dir": ...}), None for a
+                          FeatureCache with default arguments or False to disable. Per-sample cache of the outputs of branches
+                          that are frozen and deterministic (see _frozen), so that training with frozen ResNet and EC branches
+                          only runs fc after the first epoch. Only created if a pretrained branch is loaded frozen
+            concurrent: Whether to run the ResNet and EC branches concurrently, see run_branches
+            early_exit: Whether to add exit_layer, a classifier on the ResNet features that lets confident samples skip
+                        the EC branches in eval mode, see early_exit and early_exit.py
+        """
         super().__init__(in_channels, block, block_cfg, filter_cfg, num_classes)
+        self.feature_cache = make_cache(feature_cache)
+        self.frozen_modules = []    # kept in eval mode, see train
+        self.concurrent = concurrent
         self.dtm_1 = DTMLayer(m0=m0_1, **kwargs)
         self.topo_layer_1 = EC_TopoLayer(False, start, end, T, num_channels, hidden_features)
         self.dtm_2 = DTMLayer(m0=m0_2, **kwargs)
         self.topo_layer_2 = EC_TopoLayer(False, start_2, end_2, T, num_channels, hidden_features)
         self.relu = nn.ReLU()
         self.fc = nn.Linear(filter_cfg[-1] + 2*hidden_features[-1], num_classes)
+        self.exit_layer = nn.Linear(filter_cfg[-1], num_classes) if early_exit else None
+        if early_exit:
+            self.register_buffer("exit_threshold", torch.tensor(float("inf")))    # never exit before calibration
 
         # self.num_topo_layers = 0    # counts number of topo layers(3 if only m0=0.05 is used, 6 if m0=0.2 is also used)
         # for m in self.modules():
@@ -140,26 +182,63 @@ class EClayResNet(ResNet):
             self._load_pretrained_resnet(res_path, freeze=freeze_res)
         if load_ec:
             self._load_pretrained_eclay(ec_path, freeze=freeze_ec)
+        if self.frozen_modules and frozen_cache is not False:
+            self.frozen_cache = make_cache({} if frozen_cache is None else frozen_cache)
+        else:
+            self.frozen_cache = None
     
     def forward(self, input):
-        # ResNet
-        x_1 = self.res_layers(input)
-        x_1 = self.avg_pool(x_1)
+        if self.exit_layer is not None and not self.training:
+            return early_exit(self, input)
+        # ResNet, EC Layer 1 and EC Layer 2
+        x_1, x_2, x_3 = run_branches(input, self._res_branch, *self._topo_branches(), concurrent=self.concurrent)
+        return self._classify(x_1, x_2, x_3)
 
-        # EC Layer 1
-        x_2 = self.dtm_1(input)
-        x_2 = self.topo_layer_1(x_2)
+    def _classify(self, x_1, x_2, x_3):
         x_2 = self.relu(x_2)
-
-        # EC Layer 2
-        x_3 = self.dtm_2(input)
-        x_3 = self.topo_layer_2(x_3)
         x_3 = self.relu(x_3)
 
         x = torch.concat((x_1, x_2, x_3), dim=-1)
         x = self.fc(x)
         return x
 
+    def _topo_branches(self):
+        return [lambda x: self._ec_branch(x, self.dtm_1, self.topo_layer_1),
+                lambda x: self._ec_branch(x, self.dtm_2, self.topo_layer_2)]
+
+    def _cnn_branch(self, input):
+        return self._res_branch(input)
+
+    def _res_branch(self, input):
+        if self.frozen_cache is not None and self._frozen(self.res_layers):
+            return self.frozen_cache(input, (self.res_layers, self.avg_pool))
+        x = self.res_layers(input)
+        return self.avg_pool(x)
+
+    def _ec_branch(self, input, dtm, topo_layer):
+        if self.frozen_cache is not None and self._frozen(topo_layer):
+            return self.frozen_cache(input, (dtm, topo_layer))
+        return topo_branch(input, dtm, topo_layer, self.feature_cache)
+
+    def _frozen(self, module):
+        """
+        Whether the output of module is a fixed function of its input: frozen when loading pretrained weights (see
+        frozen_modules), no trainable parameters, no BatchNorm using batch statistics and no dropout. Modules without
+        parameters for another reason (e.g. after quantize_model) are not cached.
+        """
+        if not any(module is m for m in self.frozen_modules):
+            return False
+        if any(p.requires_grad for p in module.parameters()):
+            return False
+        return not any(m.training and isinstance(m, (nn.modules.batchnorm._BatchNorm, nn.modules.dropout._DropoutNd))
+                       for m in module.modules())
+
+    def train(self, mode=True):
+        super().train(mode)
+        for m in self.frozen_modules:   # frozen branches keep their running statistics
+            m.eval()
+        return self
+
     def _load_pretrained_eclay(self, weight_path_1,
                               weigth_path_2=None, freeze=False):
         model_dict = self.state_dict()
@@ -179,6 +258,7 @@ class EClayResNet(ResNet):
             for m in self.modules():
                 if isinstance(m, EC_TopoLayer):
                     m.requires_grad_(False)
+                    self.frozen_modules.append(m.eval())
 
     def _load_pretrained_resnet(self, weight_path, freeze=False):
         model_dict = self.state_dict()
@@ -193,6 +273,7 @@ class EClayResNet(ResNet):
             for m in self.modules():
                 if isinstance(m, nn.Conv2d) or isinstance(m, nn.BatchNorm2d):
                     m.requires_grad_(False)
+            self.frozen_modules.append(self.res_layers.eval())
 
 
 # class ResNet18_8(ResNet):
@@ -221,31 +302,56 @@ class EClayResNet(ResNet):
 
 
 class CNN_2(nn.Module):
-    def __init__(self, in_channels=1, num_classes=10):
+    def __init__(self, in_channels=1, num_classes=10, early_exit=False):
+        """
+        Images of any size are accepted: the output of conv_layer is pooled to 28x28 (the identity for 28x28 images), which
+        gives the 784 input features of fc.
+
+        Args:
+            early_exit: Used by the hybrid subclasses. Whether to add exit_layer, a classifier on the CNN features that lets
+                        confident samples skip the topology branches in eval mode, see early_exit and early_exit.py
+        """
         super().__init__()
         self.conv_layer = nn.Sequential(nn.Conv2d(in_channels, out_channels=32, kernel_size=3, stride=1, padding=1),
                                         nn.ReLU(),
                                         nn.Conv2d(in_channels=32, out_channels=1, kernel_size=3, stride=1, padding=1))
+        self.pool = nn.AdaptiveAvgPool2d(28)
         self.flatten = nn.Flatten()
         self.relu = nn.ReLU()
         self.fc = nn.Sequential(nn.Linear(784, 64),
                                 nn.ReLU(),
                                 nn.Linear(64, num_classes))
+        self.exit_layer = nn.Sequential(nn.ReLU(), nn.Linear(784, num_classes)) if early_exit else None
+        if early_exit:
+            self.register_buffer("exit_threshold", torch.tensor(float("inf")))    # never exit before calibration
 
     def forward(self, input):
         x = self.conv_layer(input)
+        x = self.pool(x)
         x = self.flatten(x)
         x = self.relu(x)
         x = self.fc(x)
         return x
 
+    def _cnn_branch(self, input):
+        return self.flatten(self.pool(self.conv_layer(input)))
+
+    def _classify(self, *features):
+        x = torch.concat(features, dim=-1)
+        x = self.relu(x)
+        x = self.fc(x)
+        return x
+
 
 class EC_CNN_2(CNN_2):
     def __init__(self, in_channels=1, num_classes=10,   # CNN params
                  start=0, end=7, T=32, num_channels=1, hidden_features=[64, 32],   # EC parameters
                  start_2=1, end_2=8,                            # EC parameters 2
-                 use_dtm=True, m0_1=0.05, m0_2=0.2, **kwargs):  # DTM parameters
-        super().__init__(in_channels, num_classes)
+                 use_dtm=True, m0_1=0.05, m0_2=0.2, feature_cache=None, concurrent=True,  # DTM parameters
+                 early_exit=False, **kwargs):
+        super().__init__(in_channels, num_classes, early_exit)
+        self.feature_cache = make_cache(feature_cache)
+        self.concurrent = concurrent    # run the CNN and topology branches concurrently, see run_branches
         self.dtm_1 = DTMLayer(m0=m0_1, **kwargs)
         self.topo_layer_1 = EC_TopoLayer(False, start, end, T, num_channels, hidden_features)
         self.dtm_2 = DTMLayer(m0=m0_2, **kwargs)
@@ -256,31 +362,26 @@ class EC_CNN_2(CNN_2):
 
 
     def forward(self, input):
-        # CNN
-        x_1 = self.conv_layer(input)
-        x_1 = self.flatten(x_1)
-        
-        # EC Layer 1
-        x_2 = self.dtm_1(input)
-        x_2 = self.topo_layer_1(x_2)
+        if self.exit_layer is not None and not self.training:
+            return early_exit(self, input)
+        # CNN, EC Layer 1 and EC Layer 2
+        x_1, x_2, x_3 = run_branches(input, self._cnn_branch, *self._topo_branches(), concurrent=self.concurrent)
+        return self._classify(x_1, x_2, x_3)
 
-        # EC Layer 2
-        x_3 = self.dtm_2(input)
-        x_3 = self.topo_layer_2(x_3)
-
-        # FC Layer
-        x = torch.concat((x_1, x_2, x_3), dim=-1)
-        x = self.relu(x)
-        x = self.fc(x)
-        return x
+    def _topo_branches(self):
+        return [lambda x: topo_branch(x, self.dtm_1, self.topo_layer_1, self.feature_cache),
+                lambda x: topo_branch(x, self.dtm_2, self.topo_layer_2, self.feature_cache)]
 
 
 class PL_CNN_2(CNN_2):
     def __init__(self, in_channels=1, num_classes=10,   # CNN params
                  start=0, end=7, T=32, K_max=2, dimensions=[0, 1], num_channels=1, hidden_features=[32],   # PL parameters
                  start_2=1, end_2=8, K_max_2=3,                 # PL parameters 2
-                 use_dtm=True, m0_1=0.05, m0_2=0.2, **kwargs):  # DTM parameters
-        super().__init__(in_channels, num_classes)
+                 use_dtm=True, m0_1=0.05, m0_2=0.2, feature_cache=None, concurrent=True,  # DTM parameters
+                 early_exit=False, **kwargs):
+        super().__init__(in_channels, num_classes, early_exit)
+        self.feature_cache = make_cache(feature_cache)
+        self.concurrent = concurrent    # run the CNN and topology branches concurrently, see run_branches
         self.dtm_1 = DTMLayer(m0=m0_1, **kwargs)
         self.topo_layer_1 = PL_TopoLayer(False, start, end, T, K_max, dimensions, num_channels, hidden_features)
         self.dtm_2 = DTMLayer(m0=m0_2, **kwargs)
@@ -290,20 +391,12 @@ class PL_CNN_2(CNN_2):
                                 nn.Linear(64, num_classes))
 
     def forward(self, input):
-        # CNN
-        x_1 = self.conv_layer(input)
-        x_1 = self.flatten(x_1)
-        
-        # PL Layer 1
-        x_2 = self.dtm_1(input)
-        x_2 = self.topo_layer_1(x_2)
-
-        # PL Layer 2
-        x_3 = self.dtm_2(input)
-        x_3 = self.topo_layer_2(x_3)
-
-        # FC Layer
-        x = torch.concat((x_1, x_2, x_3), dim=-1)
-        x = self.relu(x)
-        x = self.fc(x)
-        return x
\ No newline at end of file
+        if self.exit_layer is not None and not self.training:
+            return early_exit(self, input)
+        # CNN, PL Layer 1 and PL Layer 2
+        x_1, x_2, x_3 = run_branches(input, self._cnn_branch, *self._topo_branches(), concurrent=self.concurrent)
+        return self._classify(x_1, x_2, x_3)
+
+    def _topo_branches(self):
+        return [lambda x: topo_branch(x, self.dtm_1, self.topo_layer_1, self.feature_cache),
+                lambda x: topo_branch(x, self.dtm_2, self.topo_layer_2, self.feature_cache)]
\ No newline at end of file
@@ -3,21 +3,24 @@ import torch.nn as nn
 from dtm import DTMLayer
 from pllay import PL_TopoLayer
 from eclay import EC_TopoLayer
+from cache import topo_branch, make_cache
 
 
 class Pllay(nn.Module):
     def __init__(self, num_classes,
                  start=0, end=7, T=32, K_max=2, dimensions=[0, 1], num_channels=1, hidden_features=[32],   # PL parameters
-                 use_dtm=True, **kwargs):  # DTM parameters
+                 use_dtm=True, feature_cache=None, **kwargs):  # DTM parameters
         """
         Args:
             out_features: output dimension of fc layer
             num_classes: number of classes for classification
             use_dtm: whether to use DTM filtration
+            feature_cache: FeatureCache or dict of its arguments. If given, features before gtheta_layer are cached per sample
             kwargs: parameters for dtm
                     ex) m0=0.05, lims=[[1,28], [1,28]], size=[28, 28], r=2
         """
         super().__init__()
+        self.feature_cache = make_cache(feature_cache)
         self.use_dtm = use_dtm
         if use_dtm:
             self.dtm = DTMLayer(**kwargs)
@@ -35,11 +38,7 @@ class Pllay(nn.Module):
         Returns:
             output: Tensor of shape [batch_size, num_classes]
         """
-        if self.use_dtm:
-            x = self.dtm(input)
-        else:
-            x = input
-        x = self.topo_layer(x)
+        x = topo_branch(input, self.dtm if self.use_dtm else None, self.topo_layer, self.feature_cache)
         x = self.relu(x)
         output = self.fc(x)
         return output
@@ -49,16 +48,18 @@ class Pllay2(nn.Module):
     def __init__(self, num_classes,
                  start=0, end=7, T=32, K_max=2, dimensions=[0, 1], num_channels=1, hidden_features=[32],   # PL parameters
                  start_2=1, end_2=8, K_max_2=3,                             # PL parameters 2
-                 use_dtm=True, m0_1=0.05, m0_2=0.2, **kwargs):  # DTM parameters
+                 use_dtm=True, m0_1=0.05, m0_2=0.2, feature_cache=None, **kwargs):  # DTM parameters
         """
         Args:
             out_features: output dimension of fc layer
             num_classes: number of classes for classification
             use_dtm: whether to use DTM filtration
+            feature_cache: FeatureCache or dict of its arguments. If given, features before gtheta_layer are cached per sample
             kwargs: parameters for dtm
                     ex) m0=0.05, lims=[[1,28], [1,28]], size=[28, 28], r=2
         """
         super().__init__()
+        self.feature_cache = make_cache(feature_cache)
         self.dtm_1 = DTMLayer(m0=m0_1, **kwargs)
         self.topo_layer_1 = PL_TopoLayer(False, start, end, T, K_max, dimensions, num_channels, hidden_features)
         self.dtm_2 = DTMLayer(m0=m0_2, **kwargs)
@@ -74,11 +75,9 @@ class Pllay2(nn.Module):
         Returns:
             output: Tensor of shape [batch_size, num_classes]
         """
-        x_1 = self.dtm_1(input)
-        x_1 = self.topo_layer_1(x_1)
+        x_1 = topo_branch(input, self.dtm_1, self.topo_layer_1, self.feature_cache)
 
-        x_2 = self.dtm_2(input)
-        x_2 = self.topo_layer_2(x_2)
+        x_2 = topo_branch(input, self.dtm_2, self.topo_layer_2, self.feature_cache)
 
         x = torch.concat((x_1, x_2), dim=-1)
         x = self.relu(x)
@@ -89,16 +88,18 @@ class Pllay2(nn.Module):
 class EClay(nn.Module):
     def __init__(self, num_classes,
                  start=0, end=7, T=32, num_channels=1, hidden_features=[64, 32],   # EC parameters
-                 use_dtm=True, **kwargs):  # DTM parameters
+                 use_dtm=True, feature_cache=None, **kwargs):  # DTM parameters
         """
         Args:
             out_features: output dimension of fc layer
             num_classes: number of classes for classification
             use_dtm: whether to use DTM filtration
+            feature_cache: FeatureCache or dict of its arguments. If given, features before gtheta_layer are cached per sample
             kwargs: parameters for dtm
                     ex) m0=0.05, lims=[[1,28], [1,28]], size=[28, 28], r=2
         """
         super().__init__()
+        self.feature_cache = make_cache(feature_cache)
         self.use_dtm = use_dtm
         if use_dtm:
             self.dtm = DTMLayer(**kwargs)
@@ -116,12 +117,8 @@ class EClay(nn.Module):
         Returns:
             output: Tensor of shape [batch_size, num_classes]
         """
-        if self.use_dtm:
-            x = self.dtm(input)
-        else:
-            x = input
-        x = self.topo_layer(x)
-        x = self.relu()
+        x = topo_branch(input, self.dtm if self.use_dtm else None, self.topo_layer, self.feature_cache)
+        x = self.relu(x)
         output = self.fc(x)
         return output
 
@@ -130,16 +127,18 @@ class EClay2(nn.Module):
     def __init__(self, num_classes,
                  start=0, end=7, T=32, num_channels=1, hidden_features=[64, 32],   # EC parameters
                  start_2=1, end_2=8,                            # EC parameters 2
-                 use_dtm=True, m0_1=0.05, m0_2=0.2, **kwargs):  # DTM parameters
+                 use_dtm=True, m0_1=0.05, m0_2=0.2, feature_cache=None, **kwargs):  # DTM parameters
         """
         Args:
             out_features: output dimension of fc layer
             num_classes: number of classes for classification
             use_dtm: whether to use DTM filtration
+            feature_cache: FeatureCache or dict of its arguments. If given, features before gtheta_layer are cached per sample
             kwargs: parameters for dtm
                     ex) m0=0.05, lims=[[1,28], [1,28]], size=[28, 28], r=2
         """
         super().__init__()
+        self.feature_cache = make_cache(feature_cache)
         self.dtm_1 = DTMLayer(m0=m0_1, **kwargs)
         self.topo_layer_1 = EC_TopoLayer(False, start, end, T, num_channels, hidden_features)
         self.dtm_2 = DTMLayer(m0=m0_2, **kwargs)
@@ -155,11 +154,9 @@ class EClay2(nn.Module):
         Returns:
             output: Tensor of shape [batch_size, num_classes]
         """
-        x_1 = self.dtm_1(input)
-        x_1 = self.topo_layer_1(x_1)
+        x_1 = topo_branch(input, self.dtm_1, self.topo_layer_1, self.feature_cache)
 
-        x_2 = self.dtm_2(input)
-        x_2 = self.topo_layer_2(x_2)
+        x_2 = topo_branch(input, self.dtm_2, self.topo_layer_2, self.feature_cache)
 
         x = torch.concat((x_1, x_2), dim=-1)
         x = self.relu(x)
@@ -0,0 +1,74 @@
+import torch
+import torch.nn as nn
+from eclay import EC_Layer
+from pllay import PL_Layer
+
+
+class Patch_Layer(nn.Module):
+    def __init__(self, topo_layer, patch_size=[32, 32], stride=[16, 16], chunk_size=4096):
+        """
+        Spatially resolved topology. The input is split into (overlapping) patches and topo_layer is applied to all patches
+        of the batch as one large batch, so that every small complex shares one cached GridSkeleton and stays in cache.
+
+        Args:
+            topo_layer: EC_Layer or PL_Layer, applied to every patch
+            patch_size: list or tuple in the form of [pH, pW]
+            stride: list or tuple in the form of [sH, sW]. Same as nn.Unfold, pixels that don't fill a last patch are dropped
+            chunk_size: Max number of patches per call of topo_layer
+        """
+        super().__init__()
+        self.topo_layer = topo_layer
+        self.patch_size = list(patch_size)
+        self.stride = list(stride)
+        self.chunk_size = chunk_size
+
+    def forward(self, input):
+        """
+        Args:
+            input: Tensor of shape [batch_size, C, H, W]
+        Returns:
+            output: Tensor of shape [batch_size, C, nH, nW, T] for EC_Layer or [batch_size, C, nH, nW, len_dim, K_max, T] for PL_Layer
+        """
+        (pH, pW), (sH, sW) = self.patch_size, self.stride
+        batch_size, C = input.shape[:2]
+        patches = input.unfold(2, pH, sH).unfold(3, pW, sW)     # shape: [batch_size, C, nH, nW, pH, pW]
+        nH, nW = patches.shape[2:4]
+        patches = patches.permute(0, 2, 3, 1, 4, 5).reshape(-1, C, pH, pW)  # shape: [(batch_size*nH*nW), C, pH, pW]
+        output = torch.cat([self.topo_layer(chunk) for chunk in patches.split(self.chunk_size)])   # shape: [(batch_size*nH*nW), C, ...]
+        output = output.view(batch_size, nH, nW, *output.shape[1:])
+        return output.movedim(3, 1)
+
+
+class Patch_TopoLayer(nn.Module):
+    def __init__(self, topo_layer, patch_size=[32, 32], stride=[16, 16], out_channels=16, chunk_size=4096):
+        """
+        Topology feature map for CNN layers downstream. Features of each patch are flattened into channels and mixed by a 1x1 conv.
+
+        Args:
+            topo_layer: EC_Layer or PL_Layer
+            patch_size: list or tuple in the form of [pH, pW]
+            stride: list or tuple in the form of [sH, sW]
+            out_channels: Number of channels of the feature map
+            chunk_size: Max number of patches per call of topo_layer
+        """
+        super().__init__()
+        if isinstance(topo_layer, EC_Layer):
+            in_channels = topo_layer.num_channels * topo_layer.T
+        elif isinstance(topo_layer, PL_Layer):
+            in_channels = topo_layer.num_channels * topo_layer.len_dim * topo_layer.K_max * topo_layer.T
+        else:
+            raise ValueError(f"topo_layer has to be EC_Layer or PL_Layer, got {type(topo_layer).__name__}")
+        self.patch_layer = Patch_Layer(topo_layer, patch_size, stride, chunk_size)
+        self.conv = nn.Conv2d(in_channels, out_channels, kernel_size=1)
+        self.relu = nn.ReLU()
+
+    def forward(self, input):
+        """
+        Args:
+            input: Tensor of shape [batch_size, C, H, W]
+        Returns:
+            output: Tensor of shape [batch_size, out_channels, nH, nW]
+        """
+        x = self.patch_layer(input)                 # shape: [batch_size, C, nH, nW, ...]
+        x = x.movedim((2, 3), (-2, -1)).flatten(1, -3)  # shape: [batch_size, (C*...), nH, nW]
+        return self.relu(self.conv(x))
@@ -0,0 +1,355 @@
+import numpy as np
+import torch
+from diagram import DiagramBatch
+
+
+def cubical_persistence(input, superlevel=False, dimensions=[0, 1], cutoff=None):
+    """
+    Calculates persistence of a batch of images with gudhi and returns the diagrams as flat arrays.
+    Essential classes are paired with the pixel of maximum value, same as torch_topological.
+
+    Args:
+        input: Tensor of shape [batch_size, C, H, W]
+        superlevel: Whether to calculate topological features based on superlevel sets. If set to False, uses sublevels sets
+        dimensions: Homology dimensions to keep
+        cutoff: If given, diagrams are truncated at this filtration value (see _to_diagram_batch). gudhi still computes the whole filtration
+    Returns:
+        diagrams: DiagramBatch grouped in order of batch_size, channel and dimension
+    """
+    import gudhi    # only this backend needs it, importing it takes longer than building a model
+    batch_size, C, H, W = input.shape
+    np_input = input.detach().cpu().numpy().reshape(batch_size * C, H * W)
+    if superlevel:
+        np_input = -np_input
+
+    index_list = []
+    counts = np.zeros(batch_size * C * len(dimensions), dtype=np.int64)
+    for n in range(batch_size * C):
+        img = np_input[n]
+        cub_cpx = gudhi.CubicalComplex(dimensions=[W, H], top_dimensional_cells=img)     # gudhi expects the fastest varying axis first
+        cub_cpx.compute_persistence()
+        regular, essential = cub_cpx.cofaces_of_persistence_pairs()   # list of 2 lists of numpy arrays
+        max_index = img.argmax()
+        for d, dim in enumerate(dimensions):
+            pairs = regular[dim] if dim < len(regular) else np.empty((0, 2), dtype=np.int64)
+            if dim < len(essential) and len(essential[dim]) > 0:  # pair off essential classes with the maximum
+                infinite_pairs = np.stack([essential[dim], np.full_like(essential[dim], max_index)], 1)
+                pairs = np.concatenate([pairs, infinite_pairs])
+            index_list.append(pairs + (n % C) * H * W)      # position inside the flattened sample of shape [(C*H*W)]
+            counts[n * len(dimensions) + d] = len(pairs)
+    return _to_diagram_batch(np_input, index_list, counts, C, dimensions, [H, W], cutoff)
+
+
+class GridSkeleton:
+    def __init__(self, H, W):
+        """
+        Cell structure of the cubical complex of an H x W image that does not depend on the filtration values.
+        Pixels are top dimensional cells, so 0-dim homology is tracked on the 8-connected pixel graph and 1-dim homology
+        on the 4-connected graph of the complement (Alexander duality), where boundary pixels connect to an outer node of index H*W.
+
+        Args:
+            H: height of image
+            W: width of image
+        """
+        self.H, self.W = H, W
+        pixel = np.arange(H * W).reshape(H, W)
+        right = np.stack((pixel[:, :-1].ravel(), pixel[:, 1:].ravel()), 1)
+        down = np.stack((pixel[:-1, :].ravel(), pixel[1:, :].ravel()), 1)
+        diag = np.stack((pixel[:-1, :-1].ravel(), pixel[1:, 1:].ravel()), 1)
+        anti_diag = np.stack((pixel[:-1, 1:].ravel(), pixel[1:, :-1].ravel()), 1)
+        border = np.unique(np.concatenate((pixel[0], pixel[-1], pixel[:, 0], pixel[:, -1])))
+        outer = np.stack((border, np.full_like(border, H * W)), 1)
+
+        self.edges = np.concatenate((right, down, diag, anti_diag))     # shape: [E_8, 2]
+        self.dual_edges = np.concatenate((right, down, outer))           # shape: [E_4, 2]
+
+        # neighbors of each pixel padded with H*W, which is a sentinel in the pixel graph and the outer node in the complement
+        padded = np.full((H + 2, W + 2), H * W)
+        padded[1:-1, 1:-1] = pixel
+        shift = lambda dy, dx: padded[1+dy:H+1+dy, 1+dx:W+1+dx].ravel()
+        self.neighbors = np.stack([shift(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx], 1)   # shape: [(H*W), 8]
+        self.dual_neighbors = np.stack([shift(dy, dx) for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1))], 1)  # shape: [(H*W), 4]
+
+
+_skeletons = {}
+
+
+def get_skeleton(H, W):
+    """
+    Returns the GridSkeleton of size (H, W), which is built only once per run.
+    """
+    if (H, W) not in _skeletons:
+        _skeletons[(H, W)] = GridSkeleton(H, W)
+    return _skeletons[(H, W)]
+
+
+def _elder_pairs(edges, killers, key):
+    """
+    Union-find over edges in order of entry. Each component is represented by its oldest node (smallest key),
+    and when two components merge the younger one dies at the node that enters with the edge.
+
+    Args:
+        edges: numpy array of shape [E, 2], sorted by entry
+        killers: numpy array of shape [E, ], node that enters with each edge
+        key: list of entry order of each node
+    Returns:
+        pairs: list of (oldest node of the dying component, node that killed it)
+        parent: list of parent of each node, roots of components still alive at the end point to themselves
+    """
+    parent = list(range(len(key)))
+    pairs = []
+    for (u, v), killer in zip(edges.tolist(), killers.tolist()):
+        ru = u
+        while parent[ru] != ru:
+            parent[ru] = parent[parent[ru]]
+            ru = parent[ru]
+        rv = v
+        while parent[rv] != rv:
+            parent[rv] = parent[parent[rv]]
+            rv = parent[rv]
+        if ru == rv:
+            continue
+        if key[ru] > key[rv]:
+            ru, rv = rv, ru     # ru is older
+        parent[rv] = ru
+        if rv != killer:        # skip pairs of zero length (a node that merges as soon as it enters)
+            pairs.append((rv, killer))
+    return pairs, parent
+
+
+def _gradient_basins(key, neighbors, nodes):
+    """
+    Contracts every node with its lowest neighbor if that one enters earlier (discrete gradient) and follows the pointers
+    down to a local minimum. This never changes the pairs, since a node that enters next to an existing component
+    merges into it as the younger one. Flat regions (ties are broken by position) and monotone slopes collapse into one basin.
+
+    Args:
+        key: numpy array of shape [num_nodes, ], entry order of each node
+        neighbors: numpy array of shape [n, deg]
+        nodes: numpy array of shape [n, ], node that each row of neighbors belongs to
+    Returns:
+        basin: numpy array of shape [num_nodes, ], local minimum that each node is contracted to
+    """
+    neighbor_key = key[neighbors]                       # shape: [n, deg]
+    lowest = neighbor_key.argmin(1)
+    row = np.arange(len(nodes))
+    descend = neighbor_key[row, lowest] < key[nodes]
+    basin = np.arange(len(key))
+    basin[nodes[descend]] = neighbors[row, lowest][descend]
+    while True:     # pointer jumping until every node points at its local minimum
+        next_basin = basin[basin]
+        if np.array_equal(next_basin, basin):
+            return basin
+        basin = next_basin
+
+
+def _batch_pairs(key, neighbors, edges, simplify=True, max_entry=None):
+    """
+    Pairs of N images at once. Nodes of image n have ids n*M + (local id), so all vectorized steps run over the whole batch
+    and only the union-find over the remaining edges runs in python.
+
+    Args:
+        key: numpy array of shape [N, M], entry order of each node of each image
+        neighbors: numpy array of shape [HW, deg], local ids of neighbors of each pixel
+        edges: numpy array of shape [E, 2], local ids
+        simplify: Whether to shrink the graph before union-find. Out of all edges between two basins only the one that enters first can merge them
+        max_entry: numpy array of shape [N, ]. If given, edges of image n entering at or after max_entry[n] are skipped. Components still alive then, except the oldest one
+                   of each image, are paired with the extra node (local id M-1) of their image
+    Returns:
+        pairs: numpy array of shape [n, 2], ids of (oldest node of the dying component, node that killed it)
+    """
+    N, M = key.shape
+    shift = np.arange(N) * M
+    key = key.ravel()
+    edges = (edges[None] + shift.reshape(-1, 1, 1)).reshape(-1, 2)    # shape: [(N*E), 2]
+    if simplify:
+        nodes = (np.arange(len(neighbors)) + shift.reshape(-1, 1)).ravel()
+        basin = _gradient_basins(key, (neighbors[None] + shift.reshape(-1, 1, 1)).reshape(len(nodes), -1), nodes)
+        bu, bv = basin[edges[:, 0]], basin[edges[:, 1]]
+        between = bu != bv
+        edges, bu, bv = edges[between], bu[between], bv[between]
+    else:
+        bu, bv = edges[:, 0], edges[:, 1]
+    entry = np.maximum(key[edges[:, 0]], key[edges[:, 1]])
+    if max_entry is not None:
+        visible = entry < max_entry[edges[:, 0] // M]
+        edges, bu, bv, entry = edges[visible], bu[visible], bv[visible], entry[visible]
+    killers = np.where(key[edges[:, 0]] > key[edges[:, 1]], edges[:, 0], edges[:, 1])
+
+    if simplify:    # keep the first edge between each pair of basins
+        lo, hi = np.minimum(bu, bv), np.maximum(bu, bv)
+        order = np.lexsort((entry, hi, lo))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (lo[order][1:] != lo[order][:-1]) | (hi[order][1:] != hi[order][:-1])
+        order = order[first]
+    else:
+        order = np.arange(len(entry))
+    order = order[np.argsort(entry[order], kind="stable")]     # images are independent, so their edges can interleave
+    pairs, parent = _elder_pairs(np.stack((bu[order], bv[order]), 1), killers[order], key.tolist())
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    if max_entry is not None:
+        node = np.arange(len(key))
+        root = (np.array(parent) == node) & (key > key.reshape(N, M).min(1).repeat(M)) & (key < max_entry.repeat(M))
+        if simplify:
+            root &= basin == node
+        alive = node[root]
+        pairs = np.concatenate((pairs, np.stack((alive, alive // M * M + M - 1), 1)))
+    return pairs
+
+
+def grid_persistence(input, superlevel=False, dimensions=[0, 1], simplify=True, cutoff=None):
+    """
+    Calculates persistence of a batch of images with union-find on a GridSkeleton that is reused for every image of the same size,
+    so that the cost per image is only the sort of the filtration and the reduction. Gives the same diagrams as cubical_persistence.
+
+    There is no incremental (vineyard) update for filtrations close to one computed before, e.g. the same image under another
+    corruption level: union-find keeps no reduced boundary matrix whose pairs could be transposed, and a DTM filtration changes
+    at every pixel when the point cloud does, so an update would cost the same sort as a new call.
+
+    Args:
+        input: Tensor of shape [batch_size, C, H, W]
+        superlevel: Whether to calculate topological features based on superlevel sets. If set to False, uses sublevels sets
+        dimensions: Homology dimensions to keep, 0 or 1
+        simplify: Whether to collapse flat regions and monotone slopes before the reduction
+        cutoff: If given, the filtration stops at this value (see _to_diagram_batch). Edges of the pixel graph entering after
+                the cutoff are skipped, and pixels entering after the cutoff are tied into one flat region of the complement,
+                so that simplify collapses them instead of reducing them
+    Returns:
+        diagrams: DiagramBatch grouped in order of batch_size, channel and dimension
+    """
+    batch_size, C, H, W = input.shape
+    N, HW = batch_size * C, H * W
+    np_input = input.detach().cpu().numpy().reshape(N, HW)
+    if superlevel:
+        np_input = -np_input
+
+    filtration = np_input if cutoff is None else np.where(np_input > cutoff, np.inf, np_input)
+    order = np.argsort(filtration, axis=1, kind="stable")   # total order of pixels, ties broken by position
+    return _grid_diagrams(np_input, order, C, [H, W], dimensions, simplify, cutoff)
+
+
+def quantized_persistence(input, superlevel=False, dimensions=[0, 1], step=None, offset=None, simplify=True, cutoff=None):
+    """
+    Calculates persistence of the filtration quantized to 16 bit levels [offset + k*step, offset + (k+1)*step), so that pixels are
+    ordered with the radix sort numpy uses for 16 bit integers instead of a comparison sort of floats. Diagrams are reported on the
+    quantized scale, i.e. every value is replaced by the midpoint of its level.
+
+    Quantization is monotone, so the pairs are those of the real filtration with every value moved by at most step/2
+    (pairs that fall on one level vanish). Hence diagrams are within step/2 of the exact ones in bottleneck distance and landscapes,
+    being 1-Lipschitz, are off by at most step/2. If step divides the spacing of tseq and offset is a point of tseq, no level
+    contains a point of tseq in its interior, so betti numbers and EC on tseq are exact (up to values within float rounding of tseq).
+    Values more than 65534 levels above the minimum are clipped to the top level.
+
+    Args:
+        input: Tensor of shape [batch_size, C, H, W]
+        superlevel: Whether to calculate topological features based on superlevel sets. If set to False, uses sublevels sets
+        dimensions: Homology dimensions to keep, 0 or 1
+        step: Width of a level. Defaults to the range of the batch split into 65534 levels
+        offset: A value on the grid. Defaults to the minimum of the batch
+        simplify: Whether to collapse flat regions and monotone slopes before the reduction
+        cutoff: If given, the filtration stops at this value (see grid_persistence)
+    Returns:
+        diagrams: DiagramBatch grouped in order of batch_size, channel and dimension
+    """
+    batch_size, C, H, W = input.shape
+    N, HW = batch_size * C, H * W
+    np_input = input.detach().cpu().numpy().reshape(N, HW)
+    if superlevel:
+        np_input = -np_input
+    min_value = float(np_input.min())
+    if step is None:
+        step = max(float(np_input.max()) - min_value, 1e-12) / 65534
+    if offset is None:
+        offset = min_value
+    base = offset - step * np.ceil((offset - min_value) / step)  # grid point at or below the minimum
+
+    level = np.clip(np.floor((np_input - base) / step), 0, 65534).astype(np.uint16)
+    values = (base + (level + 0.5) * step).astype(np_input.dtype)
+    if cutoff is not None:
+        level[values > cutoff] = 65535    # pixels after the cutoff form one flat region on top
+    order = np.argsort(level, axis=1, kind="stable")    # radix sort
+    return _grid_diagrams(values, order, C, [H, W], dimensions, simplify, cutoff)
+
+
+def _grid_diagrams(np_input, order, C, size, dimensions, simplify=True, cutoff=None):
+    """
+    Args:
+        np_input: numpy array of shape [(batch_size*C), (H*W)], filtration values
+        order: numpy array of shape [(batch_size*C), (H*W)], pixels of each image in order of entry, consistent with np_input.
+               Pixels above the cutoff have to come last
+        C:
+        size: list in the form of [H, W]
+        dimensions:
+        simplify:
+        cutoff:
+    Returns:
+        diagrams: DiagramBatch
+    """
+    (N, HW), (H, W) = np_input.shape, size
+    M = HW + 1
+    skeleton = get_skeleton(H, W)
+    rank = np.empty((N, M), dtype=np.int64)
+    np.put_along_axis(rank, order, np.arange(HW), axis=1)
+    rank[:, HW] = HW    # sentinel of the pixel graph enters last
+    num_visible = None if cutoff is None else (np_input <= cutoff).sum(1)
+
+    pair_list, group_list = [], []
+    for d, dim in enumerate(dimensions):
+        if dim == 0:
+            pairs = _batch_pairs(rank, skeleton.neighbors, skeleton.edges, simplify, num_visible)
+        elif dim == 1:
+            key = HW - 1 - rank     # complement enters in decreasing order of pixel values
+            key[:, HW] = -1         # outer node is the oldest
+            pairs = _batch_pairs(key, skeleton.dual_neighbors, skeleton.dual_edges, simplify)[:, ::-1]  # hole is born when the component of the complement dies
+        else:
+            pairs = np.empty((0, 2), dtype=np.int64)
+        n, pairs = pairs[:, 0] // M, pairs % M
+        value = np.concatenate((np_input, np.full((N, 1), np.inf, dtype=np_input.dtype)), 1)  # killed by the sentinel: alive at the cutoff
+        keep = value[n, pairs[:, 0]] != value[n, pairs[:, 1]]    # drop pairs of zero persistence from ties
+        n, pairs = n[keep], np.where(pairs[keep] == HW, -1, pairs[keep])
+        if dim == 0:    # pair off the essential class with the maximum
+            n = np.concatenate((n, np.arange(N)))
+            pairs = np.concatenate((pairs, np.stack((np_input.argmin(1), np_input.argmax(1)), 1)))
+        pair_list.append(np.where(pairs < 0, -1, pairs + (n % C).reshape(-1, 1) * HW))   # position inside the flattened sample of shape [(C*H*W)]
+        group_list.append(n * len(dimensions) + d)
+
+    group = np.concatenate(group_list)
+    order = np.argsort(group, kind="stable")
+    counts = np.bincount(group, minlength=N * len(dimensions))
+    return _to_diagram_batch(np_input, [np.concatenate(pair_list)[order]], counts, C, dimensions, [H, W], cutoff)
+
+
+def _to_diagram_batch(np_input, index_list, counts, C, dimensions, size, cutoff=None):
+    """
+    Args:
+        np_input: numpy array of shape [(batch_size*C), (H*W)], filtration values
+        index_list: list of numpy arrays of shape [n, 2], position of birth and death pixel inside the flattened sample, in order of groups
+        counts: numpy array of shape [(batch_size*C*len_dim), ], number of points in each group
+        C:
+        dimensions:
+        size:
+        cutoff: If given, points born at or after the cutoff are dropped and deaths after the cutoff are set to the cutoff,
+                with death pixel -1 since they don't depend on the input
+    Returns:
+        diagrams: DiagramBatch
+    """
+    batch_size = len(counts) // (C * len(dimensions))
+    index = np.concatenate(index_list).astype(np.int64).reshape(-1, 2)
+    group = np.repeat(np.arange(len(counts)), counts)
+    sample = group // (C * len(dimensions))
+    value = np_input.reshape(batch_size, -1)
+    birth = value[sample, index[:, 0]]
+    death = np.where(index[:, 1] >= 0, value[sample, index[:, 1]], np.inf).astype(birth.dtype)
+    if cutoff is not None:
+        keep = birth < cutoff
+        index, group, birth, death = index[keep], group[keep], birth[keep], death[keep]
+        index[death > cutoff, 1] = -1
+        death = np.minimum(death, cutoff).astype(birth.dtype)
+        counts = np.bincount(group, minlength=len(counts))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = counts.cumsum()
+    return DiagramBatch(torch.from_numpy(birth), torch.from_numpy(death),
+                        torch.from_numpy(index), torch.from_numpy(offsets), C, dimensions, size)
+
+
+BACKENDS = {"gudhi": cubical_persistence, "grid": grid_persistence, "quantized": quantized_persistence}
@@ -1,9 +1,10 @@
 import numpy as np
 import torch
 import torch.nn as nn
-import gudhi
-from torch_topological.nn import CubicalComplex
 from dtm import DTMLayer
+from persistence import BACKENDS
+from diagram import DiagramBatch
+from scheduler import to_host, to_device
 
 
 # class AdPLCustomGrad(torch.autograd.Function):
@@ -140,8 +141,62 @@ from dtm import DTMLayer
 #         return land
 
 
+class SparsePLGrad(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, input, birth, death, index, offsets, tseq, K_max, superlevel=False):
+        """
+        Each landscape value is a tent function of a single diagram point, so it depends on exactly one birth or death pixel.
+        Instead of the dense Jacobian of AdPLCustomGrad, only the pixel and the sign of the slope are stored for every value.
+
+        Args:
+            input: Tensor of shape [batch_size, C, H, W], only used to map gradients back
+            birth: Tensor of shape [n, ], in the filtration domain (negated input if superlevel)
+            death: Tensor of shape [n, ]
+            index: Tensor of shape [n, 2], position of birth and death pixel in flattened input, -1 if it doesn't depend on input
+            offsets: Tensor of shape [num_groups + 1], points of group g are index[offsets[g]:offsets[g+1]]
+            tseq: Tensor of shape [1, T]
+            K_max:
+            superlevel:
+        Returns:
+            landscape: Tensor of shape [num_groups, K_max, T]
+        """
+        num_groups = len(offsets) - 1
+        counts = offsets.diff()
+        group = torch.repeat_interleave(torch.arange(num_groups), counts)  # shape: [n, ]
+        rank = torch.arange(len(group)) - offsets[group]                    # position of each point inside its group
+
+        # dummy point so that padded values have a valid pixel
+        index = torch.cat((index, index.new_full((1, 2), -1)))
+        birth = torch.cat((birth.detach(), birth.new_zeros(1))).unsqueeze(-1)   # shape: [(n+1), 1]
+        death = torch.cat((death.detach(), death.new_zeros(1))).unsqueeze(-1)   # shape: [(n+1), 1]
+
+        # pad each group with zeros up to the largest group size (at least K_max), since landscapes are nonnegative
+        temp = torch.zeros(num_groups, max(counts.max().item(), K_max), tseq.shape[-1])
+        temp[group, rank] = torch.maximum(torch.minimum(tseq - birth[:-1], death[:-1] - tseq), torch.tensor(0))    # shape: [n, T]
+        landscape, ind = torch.topk(temp, K_max, dim=1)                     # shape: [num_groups, K_max, T]
+
+        # pixel that each landscape value depends on and the sign of its derivative
+        point = (offsets[:-1].view(-1, 1, 1) + ind).clamp(max=len(group))
+        # deaths truncated at the cutoff of PL_Layer are never below the tent, though rounding can put them there at t = end
+        on_birth_side = (index[point, 1] < 0) | ((tseq - birth[point, 0]) <= (death[point, 0] - tseq))
+        pixel = torch.where(on_birth_side, index[point, 0], index[point, 1])
+        sign = torch.where(on_birth_side, -1., 1.) * (landscape > 0) * (pixel >= 0)   # zero padding, points outside support and constants have no grad
+        if superlevel:
+            sign = -sign
+        ctx.save_for_backward(pixel.clamp(min=0), sign)
+        ctx.input_shape = input.shape
+        return landscape
+
+    @staticmethod
+    def backward(ctx, up_grad):
+        pixel, sign = ctx.saved_tensors
+        down_grad = torch.zeros(ctx.input_shape.numel(), dtype=up_grad.dtype)
+        down_grad.index_add_(0, pixel.flatten(), (up_grad * sign).flatten())     # scatter-add, independent of image size
+        return down_grad.view(ctx.input_shape), None, None, None, None, None, None, None
+
+
 class PL_Layer(nn.Module):
-    def __init__(self, superlevel=False, start=0, end=7, T=32, K_max=2, dimensions=[0,1], num_channels=1):
+    def __init__(self, superlevel=False, start=0, end=7, T=32, K_max=2, dimensions=[0,1], num_channels=1, backend="gudhi", subdivision=8):
         """
         Args:
             superlevel: Whether to calculate topological features based on superlevel sets. If set to False, uses sublevels sets
@@ -151,10 +206,16 @@ class PL_Layer(nn.Module):
             K_max: 
             dimensions: 
             num_channels: Number of channels in input
+            backend: Persistence backend, one of "gudhi", "grid" or "quantized"
+            subdivision: Number of quantization levels per spacing of tseq for the "quantized" backend.
+                         Landscapes are then off by at most (end - start) / (2 * (T-1) * subdivision)
         """
         super().__init__()
-        self.cub_cpx = CubicalComplex(superlevel, dim=2)
+        self.superlevel = superlevel
+        self.backend = backend
+        self.backend_kwargs = {"step": (end - start) / ((T - 1) * subdivision), "offset": start} if backend == "quantized" else {}
         self.T = T
+        self.end = end
         self.tseq = torch.linspace(start, end, T).unsqueeze(0)  # shape: [1, T]
         self.K_max = K_max
         self.dimensions = dimensions
@@ -164,48 +225,107 @@ class PL_Layer(nn.Module):
     def forward(self, input):
         """
         Args:
-            input: Tensor of shape [batch_size, num_channels, H, W]
+            input: Tensor of shape [batch_size, num_channels, H, W] or DiagramBatch with dimensions self.dimensions
         Returns:
             landscape: Tensor of shape [batch_size, num_channels, len_dim, K_max, T]
         """
-        batch_size = input.shape[0]
-        input_device = input.device
-        if input_device.type != "cpu":
-            input = input.cpu()     # bc. calculation of persistence diagram is much faster on cpu
-
-        landscape = torch.zeros(batch_size, self.num_channels, self.len_dim, self.K_max, self.T)
-        pi_list = self.cub_cpx(input)  # lists nested in order of batch_size, channel and dimension
-        for b in range(batch_size):
-            for c in range(self.num_channels):
-                for d, dim in enumerate(self.dimensions):
-                    pi = pi_list[b][c][dim]     # error if "dim" is out of range
-                    # pd = pi.diagram[:-1] if dim == 0 else pi.diagram    # remove (birth, inf.) for dimension 0
-                    pd = pi.diagram
-                    pl = self._pd_to_pl(pd)
-                    landscape[b, c, d, :, :] = pl
-        return landscape if input_device == "cpu" else landscape.to(input_device)
-
-    def _pd_to_pl(self, pd):
+        if isinstance(input, DiagramBatch):
+            # gradients flow into birth and death values of the diagrams instead of the image
+            diagrams, input_device = input.to("cpu"), input.birth.device
+            assert diagrams.dimensions == self.dimensions
+            n = len(diagrams.birth)
+            values = torch.cat((diagrams.birth, diagrams.death))
+            index = torch.stack((torch.arange(n), torch.arange(n, 2*n)), 1)
+            superlevel = False  # values are already in the filtration domain
+        else:
+            input_device = input.device
+            if input_device.type != "cpu":
+                input = to_host(input)  # bc. calculation of persistence diagram is much faster on cpu
+            diagrams = self._diagrams(input)
+            values, index, superlevel = input, diagrams.global_index(), self.superlevel
+        batch_size = len(diagrams)
+
+        offsets = diagrams.offsets - diagrams.offsets[0]
+        landscape = SparsePLGrad.apply(values, diagrams.birth, diagrams.death, index, offsets, self.tseq, self.K_max, superlevel)    # shape: [(batch_size*num_channels*len_dim), K_max, T]
+        landscape = landscape.view(batch_size, self.num_channels, self.len_dim, self.K_max, self.T)
+        return to_device(landscape, input_device)
+
+    def _diagrams(self, input):
+        # landscapes on [start, end] only need deaths up to 2*end - (smallest birth), so the filtration can stop there
+        min_value = (-input.max() if self.superlevel else input.min()).item()
+        cutoff = max(self.end, 2*self.end - min_value + self.backend_kwargs.get("step", 0))   # quantized births are lower by at most step/2
+        return BACKENDS[self.backend](input.cpu(), self.superlevel, self.dimensions, cutoff=cutoff, **self.backend_kwargs)   # points grouped in order of batch_size, channel and dimension
+
+    def points(self, input):
         """
         Args:
-            pd: persistence diagram, shape: [n, 2]
+            input: Tensor of shape [batch_size, num_channels, H, W] or DiagramBatch with dimensions self.dimensions
         Returns:
-            pl: persistence landscapes, shape: [K_max, T]
+            birth: Tensor of shape [num_ph, ], gathered from the input so that autograd reaches the pixels
+            death: Tensor of shape [num_ph, ]
+            group: Tensor of shape [num_ph, ], (sample, channel, dimension) of each point
+            batch_size:
         """
-        num_ph = pd.shape[0]    # number of homology features (= n)
-        if num_ph == 0:         # no homology feature
-            return torch.zeros(self.K_max, self.T)
-            
-        birth = pd[:, [0]]  # shape: [n, 1]
-        death = pd[:, [1]]  # shape: [n, 1]
-        temp = torch.zeros(max(num_ph, self.K_max), self.T)
-        temp[:num_ph, :] = torch.maximum(torch.minimum(self.tseq - birth, death - self.tseq), torch.tensor(0))    # shape: [n, T]
-        pl = torch.sort(temp, dim=0, descending=True).values[:self.K_max, :]    # shape: [K_max, T]
-        return pl
+        if isinstance(input, DiagramBatch):
+            assert input.dimensions == self.dimensions
+            return input.birth, input.death, input.group, len(input)
+        diagrams = self._diagrams(input.detach())
+        values = (-input if self.superlevel else input).reshape(-1)
+        index = diagrams.global_index().to(input.device)
+        birth = values[index[:, 0]]
+        death = torch.where(index[:, 1] >= 0, values[index[:, 1].clamp(min=0)], diagrams.death.to(input.device))    # truncated deaths are constant
+        return birth, death, diagrams.group.to(input.device), len(diagrams)
+
+
+def pl_linear(birth, death, group, batch_size, tseq, K_max, weight, bias=None):
+    """
+    Same as nn.functional.linear applied to the flattened output of PL_Layer, computed straight from the diagrams.
+    The tent of a point is positive only at the t of tseq with birth < t < death, so only those (point, t) entries are built.
+    Entries of each (group, t) are ranked by value, the ones of rank k < K_max are the landscape values and are multiplied with
+    the weight column of (group, k, t) directly. The cost scales with the total support of the tents instead of num_groups*K_max*T,
+    which pays off when most points are short lived compared to [start, end]. Unlike the EC, landscapes are order statistics of the
+    tents, so a long lived point still costs one entry per t it covers.
+
+    Args:
+        birth: Tensor of shape [num_ph, ]
+        death: Tensor of shape [num_ph, ]
+        group: Tensor of shape [num_ph, ], in order of batch_size, channel and dimension
+        batch_size:
+        tseq: Tensor of shape [1, T]
+        K_max:
+        weight: Tensor of shape [out_features, (num_channels*len_dim*K_max*T)]
+        bias: Tensor of shape [out_features, ]
+    Returns:
+        output: Tensor of shape [batch_size, out_features]
+    """
+    device = weight.device
+    tseq = tseq.reshape(-1).to(device)
+    birth, death, group = birth.to(device), death.to(device), group.to(device)
+    T = len(tseq)
+    groups_per_sample = weight.shape[1] // (K_max * T)
+
+    lo = torch.searchsorted(tseq, birth.detach().to(tseq.dtype), right=True)  # first t > birth
+    hi = torch.searchsorted(tseq, death.detach().to(tseq.dtype))              # first t >= death
+    length = (hi - lo).clamp(min=0)
+    point = torch.repeat_interleave(torch.arange(len(birth), device=device), length)
+    t = torch.arange(len(point), device=device) - torch.repeat_interleave(length.cumsum(0) - length, length) + lo[point]
+    value = torch.minimum(tseq[t] - birth[point], death[point] - tseq[t])     # shape: [nnz, ]
+
+    key = group[point] * T + t
+    order = torch.argsort(value.detach(), descending=True, stable=True)
+    order = order[torch.argsort(key[order], stable=True)]      # by (group, t), then decreasing value
+    key = key[order]
+    _, run_length = torch.unique_consecutive(key, return_counts=True)
+    rank = torch.arange(len(key), device=device) - torch.repeat_interleave(run_length.cumsum(0) - run_length, run_length)
+    top = order[rank < K_max]
+    g = group[point[top]]
+    column = ((g % groups_per_sample) * K_max + rank[rank < K_max]) * T + t[top]
+    output = weight.new_zeros(batch_size, weight.shape[0]).index_add_(0, g // groups_per_sample, weight[:, column].T * value[top].unsqueeze(-1))
+    return output if bias is None else output + bias
 
 
 class PL_TopoLayer(nn.Module):
-    def __init__(self, superlevel=False, start=0, end=7, T=32, K_max=2, dimensions=[0, 1], num_channels=1, hidden_features=[32]):
+    def __init__(self, superlevel=False, start=0, end=7, T=32, K_max=2, dimensions=[0, 1], num_channels=1, hidden_features=[32], backend="gudhi", subdivision=8, fused=False):
         """
         Args:
             superlevel: 
@@ -214,9 +334,13 @@ class PL_TopoLayer(nn.Module):
             dimensions: 
             num_channels: Number of channels in input
             hidden_features: List containing the dimension of fc layers
+            backend: Persistence backend, one of "gudhi", "grid" or "quantized"
+            subdivision: Number of quantization levels per spacing of tseq for the "quantized" backend
+            fused: Whether to apply the first fc layer straight to the diagrams (see pl_linear) instead of the landscapes
         """
         super().__init__()
-        self.pl_layer = PL_Layer(superlevel, start, end, T, K_max, dimensions, num_channels)
+        self.fused = fused
+        self.pl_layer = PL_Layer(superlevel, start, end, T, K_max, dimensions, num_channels, backend, subdivision)
         self.flatten = nn.Flatten()
         self.gtheta_layer = self._make_gtheta_layer(num_channels * len(dimensions) * K_max * T, hidden_features)
 
@@ -228,7 +352,21 @@ class PL_TopoLayer(nn.Module):
         Returns:
             output: Tensor of shape [batch_size, out_features]
         """
+        if self.fused:
+            first = self.gtheta_layer[0]
+            output = pl_linear(*self.pl_layer.points(input), self.pl_layer.tseq, self.pl_layer.K_max, first.weight, first.bias)
+            return self.gtheta_layer[1:](output)
         pl = self.pl_layer(input)
+        return self.head(pl)
+
+    def head(self, pl):
+        """
+        Args:
+            pl: Tensor of shape [batch_size, num_channels, len_dim, K_max, T], output of pl_layer
+
+        Returns:
+            output: Tensor of shape [batch_size, out_features]
+        """
         pl = self.flatten(pl)   # shape: [batch_size, (num_channels * len_dim * K_max * T)]
         output = self.gtheta_layer(pl)
         return output
@@ -0,0 +1,203 @@
+import os
+import json
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+from dtm import DTMLayer
+from eclay import EC_Layer
+from pllay import PL_Layer
+from persistence import BACKENDS
+from diagram import DiagramBatch
+from cache import FeatureCache, fingerprint, _digest
+
+
+def make_branches(config):
+    """
+    Deterministic part of each topology branch, built the same way as in the models so that fingerprints match.
+
+    Args:
+        config: dict with keys layer ("ec" or "pl"), m0, start, end, K_max (one entry per branch), T, dimensions, num_channels, lims, size, r
+    Returns:
+        branches: list of tuples (DTMLayer, EC_Layer or PL_Layer)
+    """
+    branches = []
+    for i, m0 in enumerate(config["m0"]):
+        dtm = DTMLayer(m0=m0, lims=config["lims"], size=config["size"], r=config["r"])
+        if config["layer"] == "ec":
+            layer = EC_Layer(False, config["start"][i], config["end"][i], config["T"], config["num_channels"])
+        else:
+            layer = PL_Layer(False, config["start"][i], config["end"][i], config["T"], config["K_max"][i], config["dimensions"], config["num_channels"])
+        branches.append((dtm, layer))
+    return branches
+
+
+_shared = {}
+
+
+def _init_worker(x, config, paths):
+    torch.set_num_threads(1)
+    _shared.update(x=x, branches=make_branches(config), paths=paths)
+
+
+def _work(rows):
+    """
+    Computes the diagrams and features of x[rows] for every branch, writes the features into the memmaps and returns the diagrams.
+    """
+    start, stop = rows
+    x = _shared["x"][start:stop]
+    diagram_list = []
+    with torch.no_grad():
+        for (dtm, layer), path in zip(_shared["branches"], _shared["paths"]):
+            dimensions = [0, 1] if isinstance(layer, EC_Layer) else layer.dimensions
+            diagrams = BACKENDS[layer.backend](dtm(x), False, dimensions)
+            features = np.load(path, mmap_mode="r+")
+            features[start:stop] = layer(diagrams).numpy()
+            features.flush()
+            diagram_list.append(diagrams)
+    return diagram_list
+
+
+def precompute(x, config, directory, split, workers=1, chunk_size=256):
+    """
+    Args:
+        x: Tensor of shape [N, C, H, W]
+        config: see make_branches
+        directory: Output directory
+        split: "train" or "test"
+        workers: Number of worker processes
+        chunk_size: Number of samples per task
+    Returns:
+        entries: dict describing the written files, for the manifest
+    """
+    branches = make_branches(config)
+    N = len(x)
+    paths = []
+    for i, (dtm, layer) in enumerate(branches):
+        shape = [N, config["num_channels"], config["T"]] if isinstance(layer, EC_Layer) else \
+                [N, config["num_channels"], layer.len_dim, layer.K_max, config["T"]]
+        path = os.path.join(directory, f"{split}_features_{i}.npy")
+        np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=tuple(shape))
+        paths.append(path)
+
+    tasks = [(start, min(start + chunk_size, N)) for start in range(0, N, chunk_size)]
+    if workers > 1:
+        with multiprocessing.get_context("fork").Pool(workers, _init_worker, (x, config, paths)) as pool:
+            results = pool.map(_work, tasks)
+    else:
+        _init_worker(x, config, paths)
+        results = [_work(task) for task in tasks]
+
+    keys = np.array([_digest(sample) for sample in x])
+    np.save(os.path.join(directory, f"{split}_keys.npy"), keys)
+    entries = {"keys": f"{split}_keys.npy", "branches": []}
+    for i, branch in enumerate(branches):
+        diagrams = DiagramBatch.cat([diagram_list[i] for diagram_list in results])
+        files = {}
+        for name in ("birth", "death", "index", "offsets"):
+            files[name] = f"{split}_{name}_{i}.npy"
+            np.save(os.path.join(directory, files[name]), getattr(diagrams, name).numpy())
+        entries["branches"].append({"fingerprint": fingerprint(branch), "features": os.path.basename(paths[i]),
+                                    "diagrams": files, "dimensions": diagrams.dimensions})
+    return entries
+
+
+class PrecomputedFeatures:
+    def __init__(self, directory, fallback=None):
+        """
+        Feature store written by precompute.py. Can be passed as feature_cache to the models ("precomputed" input mode,
+        or {"precomputed": directory} in a config, see make_cache): samples are looked up by a hash of their contents and
+        branches by the fingerprint of their configuration, anything not in the store is computed online.
+
+        Args:
+            directory: Directory with manifest.json
+            fallback: FeatureCache for the samples not in the store. If None, they are computed every time
+        """
+        self.directory = directory
+        self.fallback = fallback
+        with open(os.path.join(directory, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.rows = {}          # sample -> (split, row)
+        self.features = {}      # (split, fingerprint) -> memmap
+        for split, entries in self.manifest["splits"].items():
+            keys = np.load(os.path.join(directory, entries["keys"]))
+            self.rows.update({key: (split, row) for row, key in enumerate(keys.tolist())})
+            for branch in entries["branches"]:
+                self.features[(split, branch["fingerprint"])] = np.load(os.path.join(directory, branch["features"]), mmap_mode="r")
+        self._tensor_digests = {}
+        self.hits, self.misses = 0, 0
+
+    def __call__(self, input, branch):
+        """
+        Args:
+            input: Tensor of shape [batch_size, C, H, W]
+            branch: tuple of modules
+        Returns:
+            output: Tensor of shape [batch_size, ...], same as applying branch to input
+        """
+        if torch.is_grad_enabled() and input.requires_grad:     # features depend on something learnable, see FeatureCache
+            return self._compute(input, branch)
+        config = fingerprint(branch, self._tensor_digests)
+        found = [self.rows.get(_digest(sample)) for sample in input.detach().cpu()]
+        found = [None if x is None or (x[0], config) not in self.features else x for x in found]
+        present = [i for i, x in enumerate(found) if x is not None]
+        missing = [i for i, x in enumerate(found) if x is None]
+        self.hits += len(present)
+        self.misses += len(missing)
+        if not present:
+            return self._compute(input, branch)
+        stored = torch.from_numpy(np.stack([self.features[(found[i][0], config)][found[i][1]] for i in present]))
+        if not missing:
+            return stored.to(input.device)
+        with torch.no_grad():
+            computed = self._compute(input[missing], branch).detach().cpu()
+        output = stored.new_empty(len(found), *stored.shape[1:])
+        output[present], output[missing] = stored, computed.to(stored.dtype)
+        return output.to(input.device)
+
+    def _compute(self, input, branch):
+        return FeatureCache._apply(branch, input) if self.fallback is None else self.fallback(input, branch)
+
+    def diagrams(self, split, i):
+        """
+        Returns:
+            diagrams: DiagramBatch of branch i of split
+        """
+        branch = self.manifest["splits"][split]["branches"][i]
+        arrays = {name: torch.from_numpy(np.load(os.path.join(self.directory, file))) for name, file in branch["diagrams"].items()}
+        return DiagramBatch(**arrays, num_channels=self.manifest["config"]["num_channels"],
+                            dimensions=branch["dimensions"], size=self.manifest["config"]["size"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data", help="directory of the dataset")
+    parser.add_argument("--layer", default="ec", choices=["ec", "pl"], help="vectorization of the diagrams")
+    parser.add_argument("--cn", nargs="+", default=["00_00"], help="corruption/noise rates of the generated data, e.g. 00_00 10_10")
+    parser.add_argument("--m0", nargs="+", type=float, default=[0.05, 0.2], help="one DTM branch per value")
+    parser.add_argument("--start", nargs="+", type=float, default=[0, 1])
+    parser.add_argument("--end", nargs="+", type=float, default=[7, 8])
+    parser.add_argument("--K_max", nargs="+", type=int, default=[2, 3])
+    parser.add_argument("--T", type=int, default=32)
+    parser.add_argument("--dimensions", nargs="+", type=int, default=[0, 1])
+    parser.add_argument("--num_channels", type=int, default=1)
+    parser.add_argument("--lims", nargs=4, type=float, default=[1, 28, 1, 28])
+    parser.add_argument("--size", nargs=2, type=int, default=[28, 28])
+    parser.add_argument("--r", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    config = {"layer": args.layer, "m0": args.m0, "start": args.start, "end": args.end, "K_max": args.K_max, "T": args.T,
+              "dimensions": args.dimensions, "num_channels": args.num_channels,
+              "lims": [args.lims[:2], args.lims[2:]], "size": args.size, "r": args.r}
+    for cn in args.cn:
+        directory = f"{args.data}/precomputed/{args.layer}_{cn}/"
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        x_train, x_test = torch.load(f"{args.data}/generated_data/x_{cn}.pt")
+        manifest = {"config": config, "source": f"{args.data}/generated_data/x_{cn}.pt", "splits": {}}
+        for split, x in (("train", x_train), ("test", x_test)):
+            print(f"{cn} {split}: {len(x)} samples")
+            manifest["splits"][split] = precompute(x, config, directory, split, args.workers)
+        with open(os.path.join(directory, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=4)
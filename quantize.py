@@ -0,0 +1,122 @@
+import time
+import argparse
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from export import load_exported
+from surrogate import load_surrogates, use_surrogates
+
+
+# learnable parts of the models, quantized when present. DTM and persistence stay in float
+QUANTIZABLE = ("conv_layer", "res_layers", "gtheta_layer", "fc", "exit_layer")
+
+
+def _engine():
+    engines = torch.backends.quantized.supported_engines
+    return next(engine for engine in ("x86", "fbgemm", "qnnpack") if engine in engines)
+
+
+def quantize_model(model, x, batch_size=64, num_batches=8):
+    """
+    Post-training static int8 quantization of the CNN/ResNet branch, gtheta_layer of the topology layers and the fc
+    layers of a model, in place. Each module is traced with torch.fx, which fuses Conv-BN(-ReLU) (e.g. conv_layer1 and relu
+    of ResidualBlock and BottleneckBlock) and Linear-ReLU, observed on calibration batches and converted to int8 kernels.
+    Quantized modules take and return float tensors, so the rest of the model is unchanged.
+
+    Args:
+        model: Trained model on cpu, e.g. EC_CNN_2, PL_CNN_2, EClayResNet or EClay
+        x: Tensor of shape [N, C, H, W], calibration images (e.g. from the train split of the generated data)
+        batch_size: Number of images per calibration batch
+        num_batches: Number of calibration batches
+    Returns:
+        model: model in eval mode
+    """
+    torch.backends.quantized.engine = _engine()
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    model.eval()
+    if hasattr(model, "frozen_cache"):
+        model.frozen_cache = None   # inference inputs are not worth hashing and keeping
+    names = [name for name, m in model.named_modules() if name.rsplit(".", 1)[-1] in QUANTIZABLE and m is not None]
+    names = [name for name in names if not any(name.startswith(other + ".") for other in names)]   # outermost only
+
+    # example inputs of each module, from one forward
+    example_inputs, hooks = {}, []
+    for name in names:
+        hook = lambda m, input, name=name: example_inputs.setdefault(name, tuple(i.detach() for i in input))
+        hooks.append(model.get_submodule(name).register_forward_pre_hook(hook))
+    with torch.no_grad():
+        model(x[:batch_size].float())
+    for hook in hooks:
+        hook.remove()
+
+    names = [name for name in names if name in example_inputs]    # e.g. exit_layer before calibration of early exit
+    for name in names:
+        parent, _, attr = name.rpartition(".")
+        parent = model.get_submodule(parent) if parent else model
+        setattr(parent, attr, prepare_fx(getattr(parent, attr), qconfig_mapping, example_inputs[name]))
+    with torch.no_grad():
+        for i in range(0, min(len(x), batch_size * num_batches), batch_size):
+            model(x[i:i+batch_size].float())
+    for name in names:
+        parent, _, attr = name.rpartition(".")
+        parent = model.get_submodule(parent) if parent else model
+        setattr(parent, attr, convert_fx(getattr(parent, attr)))
+    return model
+
+
+def report(models, x, y, batch_size=64):
+    """
+    Accuracy and latency of each model.
+
+    Args:
+        models: dict name -> model
+        x: Tensor of shape [N, C, H, W]
+        y: Tensor of shape [N, ]
+    Returns:
+        results: dict name -> dict of accuracy (%), ms_per_batch and images_per_sec
+    """
+    results, predictions = {}, {}
+    for name, model in models.items():
+        correct, seconds, y_pred_list = 0, 0, []
+        with torch.no_grad():
+            for i in range(0, len(x), batch_size):
+                X = x[i:i+batch_size].float()
+                start = time.perf_counter()
+                y_pred = model(X)
+                seconds += time.perf_counter() - start
+                correct += (y_pred.argmax(1) == y[i:i+batch_size]).sum().item()
+                y_pred_list.append(y_pred.argmax(1))
+        predictions[name] = torch.concat(y_pred_list)
+        results[name] = {"accuracy": 100 * correct / len(y), "ms_per_batch": 1000 * seconds / -(-len(x) // batch_size),
+                         "images_per_sec": len(y) / seconds}
+    print(f"{'':>6s} {'Accuracy':>9s} {'ms/batch':>9s} {'images/s':>9s}")
+    for name, r in results.items():
+        print(f"{name:>6s} {r['accuracy']:>8.1f}% {r['ms_per_batch']:>9.2f} {r['images_per_sec']:>9.1f}")
+    first, *others = predictions
+    for name in others:
+        agreement = 100 * (predictions[name] == predictions[first]).float().mean().item()
+        print(f"{name} agrees with {first} on {agreement:>0.1f}% of the predictions")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="model exported with export.py")
+    parser.add_argument("x_path", help="generated data, e.g. MNIST/generated_data/x_00_00.pt")
+    parser.add_argument("y_path", help="labels, e.g. MNIST/generated_data/y.pt")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-batches", type=int, default=8, help="number of calibration batches from the train split")
+    parser.add_argument("--surrogates", help="surrogates of the topology branches written by surrogate.py, so that only the learnable parts are timed")
+    parser.add_argument("--threads", type=int, help="number of cpu threads, default of torch if not given")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    x_train, x_test = torch.load(args.x_path)
+    _, y_test = torch.load(args.y_path)
+    fp32, int8 = load_exported(args.model), load_exported(args.model)
+    if args.surrogates is not None:
+        use_surrogates(fp32, load_surrogates(args.surrogates))
+        use_surrogates(int8, load_surrogates(args.surrogates))
+    quantize_model(int8, x_train[torch.randperm(len(x_train))], args.batch_size, args.num_batches)
+    report({"fp32": fp32, "int8": int8}, x_test, y_test, args.batch_size)
@@ -0,0 +1,75 @@
+from collections import defaultdict
+import torch
+from torch.utils.data import Sampler
+
+
+def ragged_apply(fn, images, max_batch_size=None):
+    """
+    Applies fn to images of different sizes: images of the same size are stacked and processed together (DTMLayer keeps
+    the geometry of each size), and the outputs, whose shape doesn't depend on the size (e.g. [C, T] of EC_Layer,
+    [C, len_dim, K_max, T] of PL_Layer or the logits of a model), are put back into one batch in the order of images.
+    No image is padded.
+
+    Args:
+        fn: callable taking Tensor of shape [batch_size, C, H, W], e.g. a model or lambda x: ec_layer(dtm(x))
+        images: list of Tensor of shape [C, H, W], H and W may differ between images
+        max_batch_size: Max number of images per call of fn. All images of a size in one call if None
+    Returns:
+        output: Tensor of shape [len(images), ...]
+    """
+    buckets = defaultdict(list)     # (C, H, W) -> positions in images
+    for i, image in enumerate(images):
+        buckets[tuple(image.shape)].append(i)
+    output = None
+    for rows in buckets.values():
+        step = max_batch_size or len(rows)
+        for start in range(0, len(rows), step):
+            index = rows[start:start+step]
+            x = fn(torch.stack([images[i] for i in index]))     # shape: [len(index), ...]
+            if output is None:
+                output = x.new_zeros(len(images), *x.shape[1:])
+            output = output.index_put((torch.tensor(index, device=x.device),), x)
+    return output
+
+
+class SizeBucketSampler(Sampler):
+    def __init__(self, sizes, batch_size, shuffle=True, drop_last=False, seed=0):
+        """
+        Batch sampler for datasets of mixed image sizes (e.g. a ConcatDataset of MNIST and MNIST-M): every batch holds
+        images of one size, so it can be stacked without padding. Pass as batch_sampler to DataLoader.
+
+        Args:
+            sizes: list of the size (H, W) of each sample, e.g. [tuple(x.shape[-2:]) for x, _ in dataset]
+            batch_size: Number of samples per batch
+            shuffle: Whether to shuffle samples within each size and the order of the batches, differently every epoch
+            drop_last: Whether to drop the last incomplete batch of each size
+            seed: Seed of the shuffling
+        """
+        self.buckets = defaultdict(list)    # size -> indices
+        for i, size in enumerate(sizes):
+            self.buckets[tuple(size)].append(i)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        batches = []
+        for indices in self.buckets.values():
+            if self.shuffle:
+                indices = [indices[i] for i in torch.randperm(len(indices), generator=generator).tolist()]
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start+self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.buckets.values())
+        return sum(-(-len(indices) // self.batch_size) for indices in self.buckets.values())
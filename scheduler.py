@@ -0,0 +1,94 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+
+_pool = None
+_local = threading.local()
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="branch")
+    return _pool
+
+
+def _after_fork():
+    global _pool, _local
+    _pool, _local = None, threading.local()     # threads of the parent don't exist in a forked child
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _stream(device):
+    """
+    Side stream of the calling worker thread on device.
+    """
+    streams = _local.__dict__.setdefault("streams", {})
+    if device not in streams:
+        streams[device] = torch.cuda.Stream(device)
+    return streams[device]
+
+
+def _run(branch, input, grad_enabled):
+    with torch.set_grad_enabled(grad_enabled):      # grad mode is thread local
+        if input.device.type != "cuda":
+            return branch(input)
+        stream = _stream(input.device)
+        stream.wait_stream(torch.cuda.current_stream(input.device))     # input is ready
+        with torch.cuda.stream(stream):
+            input.record_stream(stream)
+            output = branch(input)
+        return output, stream
+
+
+def run_branches(input, *branches, concurrent=True):
+    """
+    Applies the branches to input concurrently: the first one in the calling thread, the others in worker threads, each on
+    its own CUDA stream on gpu. Persistence of the topology branches runs on cpu while the convolutions run, so the time of
+    a step is that of the slowest branch instead of the sum of all branches. Gradients flow through the outputs as usual.
+
+    Args:
+        input: Tensor of shape [batch_size, C, H, W]
+        branches: callables taking input
+        concurrent: If False, the branches are applied one after the other
+    Returns:
+        outputs: list of the outputs of the branches, ready to use on the current stream
+    """
+    if not concurrent:
+        return [branch(input) for branch in branches]
+    grad_enabled = torch.is_grad_enabled()
+    futures = [_executor().submit(_run, branch, input, grad_enabled) for branch in branches[1:]]
+    outputs = [branches[0](input)]
+    for future in futures:
+        output = future.result()
+        if input.device.type == "cuda":
+            output, stream = output
+            torch.cuda.current_stream(input.device).wait_stream(stream)
+            output.record_stream(torch.cuda.current_stream(input.device))
+        outputs.append(output)
+    return outputs
+
+
+def to_host(input):
+    """
+    Copy of input in pinned cpu memory. Only waits for the current stream, so other branches keep running on the gpu.
+    """
+    if input.device.type == "cpu":
+        return input
+    output = torch.empty(input.shape, dtype=input.dtype, pin_memory=True)
+    output.copy_(input, non_blocking=True)
+    torch.cuda.current_stream(input.device).synchronize()
+    return output
+
+
+def to_device(input, device):
+    """
+    Non-blocking copy of a cpu tensor to device, through pinned memory.
+    """
+    if torch.device(device).type == "cpu":
+        return input
+    return input.pin_memory().to(device, non_blocking=True)
@@ -0,0 +1,156 @@
+import os
+import json
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+from export import load_exported
+from surrogate import load_surrogates, use_surrogates
+
+
+def open_shard(path, split=None):
+    """
+    Args:
+        path: .npy file of shape [N, C, H, W], or .pt file with a Tensor of shape [N, C, H, W] or a tuple of them,
+              e.g. (x_train, x_test) of generated_data
+        split: Position of the Tensor in the tuple
+    Returns:
+        x: memory-mapped Tensor or numpy array of shape [N, C, H, W], only the rows used are read (see rows)
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    try:
+        x = torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):   # torch < 2.1 or legacy file format
+        return np.load(_to_npy(path, split), mmap_mode="r")
+    return x if split is None else x[split]
+
+
+def _to_npy(path, split=None):
+    """
+    Converts a shard that torch can't memory-map to a .npy file next to it, once, so that neither counting its rows nor
+    the workers load it whole.
+
+    Returns:
+        npy_path: path of the .npy file
+    """
+    npy_path = f"{path}.npy" if split is None else f"{path}.{split}.npy"
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(path):
+        print(f"{path} can't be memory-mapped by torch {torch.__version__}, converting it once to {npy_path}")
+        x = torch.load(path, map_location="cpu")
+        x = x if split is None else x[split]
+        tmp_path = f"{npy_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, x.numpy())
+        os.replace(tmp_path, npy_path)  # atomic, a concurrent run never reads a partial file
+    return npy_path
+
+
+def rows(x, start, stop):
+    """
+    Returns:
+        x: Tensor of shape [stop - start, ...], rows [start, stop) of a shard from open_shard
+    """
+    x = x[start:stop]
+    return torch.from_numpy(np.array(x)) if isinstance(x, np.ndarray) else x
+
+
+_worker = {}
+
+
+def _init_worker(model_path, shards, split, output, surrogates_path=None):
+    torch.set_num_threads(1)    # one process per core
+    model = load_exported(model_path)
+    if surrogates_path is not None:
+        use_surrogates(model, load_surrogates(surrogates_path))
+    _worker.update(model=model, shards=shards, split=split, x={},
+                   logits=np.load(os.path.join(output, "logits.npy"), mmap_mode="r+"),
+                   predictions=np.load(os.path.join(output, "predictions.npy"), mmap_mode="r+"))
+
+
+def _score(task):
+    """
+    Scores rows [start, stop) of a shard and writes them at offset in the outputs.
+    """
+    chunk, shard, start, stop, offset = task
+    if shard not in _worker["x"]:
+        _worker["x"] = {shard: open_shard(_worker["shards"][shard], _worker["split"])}     # one shard open at a time
+    with torch.no_grad():
+        logits = _worker["model"](rows(_worker["x"][shard], start, stop).float())
+    _worker["logits"][offset:offset + stop - start] = logits.numpy()
+    _worker["predictions"][offset:offset + stop - start] = logits.argmax(-1).numpy()
+    _worker["logits"].flush()
+    _worker["predictions"].flush()
+    return chunk
+
+
+def score(model_path, shards, output, split=None, chunk_size=256, workers=os.cpu_count(), surrogates_path=None):
+    """
+    Streams the shards through the model with worker processes and writes logits.npy and predictions.npy in output.
+    Finished chunks are recorded in done.npy, so an interrupted run continues where it stopped when called again.
+
+    Args:
+        model_path: Model exported with export.py
+        shards: list of .pt or .npy files, see open_shard
+        output: Output directory
+        split: Position of the Tensor in each shard, if the shards hold tuples
+        chunk_size: Number of images per task
+        workers: Number of worker processes
+        surrogates_path: Surrogates of the topology branches written by surrogate.py, used instead of persistence
+    Returns:
+        num_done: Number of chunks scored in this call
+    """
+    sizes = [len(open_shard(path, split)) for path in shards]
+    tasks, offset = [], 0
+    for shard, size in enumerate(sizes):
+        for start in range(0, size, chunk_size):
+            stop = min(start + chunk_size, size)
+            tasks.append((len(tasks), shard, start, stop, offset))
+            offset += stop - start
+
+    meta = {"model": os.path.abspath(model_path), "shards": [os.path.abspath(path) for path in shards], "split": split,
+            "sizes": sizes, "chunk_size": chunk_size,
+            "surrogates": None if surrogates_path is None else os.path.abspath(surrogates_path)}
+    meta_path = os.path.join(output, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            assert json.load(f) == meta, f"{output} holds the scores of another run"
+        done = np.load(os.path.join(output, "done.npy"), mmap_mode="r+")
+    else:
+        os.makedirs(output, exist_ok=True)
+        with torch.no_grad():
+            num_classes = load_exported(model_path)(rows(open_shard(shards[0], split), 0, 1).float()).shape[-1]
+        np.lib.format.open_memmap(os.path.join(output, "logits.npy"), "w+", np.float32, (offset, num_classes))
+        np.lib.format.open_memmap(os.path.join(output, "predictions.npy"), "w+", np.int64, (offset,))
+        done = np.lib.format.open_memmap(os.path.join(output, "done.npy"), "w+", np.bool_, (len(tasks),))
+        with open(meta_path, "w") as f:     # written last, so a run interrupted before this point starts over
+            json.dump(meta, f, indent=4)
+
+    todo = [task for task in tasks if not done[task[0]]]
+    print(f"{offset} images, {len(tasks) - len(todo)}/{len(tasks)} chunks already scored")
+    with multiprocessing.get_context("fork").Pool(workers, _init_worker, (model_path, shards, split, output, surrogates_path)) as pool:
+        for i, chunk in enumerate(pool.imap_unordered(_score, todo), 1):
+            done[chunk] = True
+            if i % 100 == 0 or i == len(todo):
+                done.flush()
+                print(f"[{len(tasks) - len(todo) + i:>6d}/{len(tasks):>6d}] chunks")
+    return len(todo)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="model exported with export.py")
+    parser.add_argument("output", help="directory of logits.npy and predictions.npy")
+    parser.add_argument("shards", nargs="+", help=".pt or .npy files of images, read in order")
+    parser.add_argument("--split", type=int, help="position of the images in each shard if it holds a tuple, e.g. 1 for x_test")
+    parser.add_argument("--labels", help=".pt file of labels (same split) to report accuracy")
+    parser.add_argument("--surrogates", help="surrogates of the topology branches written by surrogate.py, skips persistence")
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    score(args.model, args.shards, args.output, args.split, args.chunk_size, args.workers, args.surrogates)
+    if args.labels is not None:
+        labels = np.asarray(open_shard(args.labels, args.split))
+        predictions = np.load(os.path.join(args.output, "predictions.npy"), mmap_mode="r")
+        correct = sum(int((predictions[i:i+2**20] == labels[i:i+2**20]).sum()) for i in range(0, len(labels), 2**20))
+        print(f"Accuracy: {100 * correct / len(labels):>0.1f}%")
@@ -0,0 +1,248 @@
+import json
+import time
+import asyncio
+import argparse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import torch.nn as nn
+from cache import _digest
+from export import load_exported
+from ragged import ragged_apply
+from surrogate import load_surrogates, use_surrogates
+
+
+def _in_channels(model):
+    """
+    Number of channels of the images model takes: in_channels of its first conv layer, or num_channels of its first
+    EC/PL layer for models without convolutions.
+    """
+    for m in model.modules():
+        if isinstance(m, nn.Conv2d):
+            return m.in_channels
+        if hasattr(m, "num_channels"):
+            return m.num_channels
+    return None
+
+
+class LatencyStats:
+    def __init__(self, window=10000):
+        """
+        Latency and throughput of the last window requests.
+        """
+        self.latencies = deque(maxlen=window)
+        self.finished = deque(maxlen=window)    # completion times
+        self.batch_sizes = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, latency):
+        self.latencies.append(latency)
+        self.finished.append(time.perf_counter())
+        self.count += 1
+
+    def report(self):
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        span = self.finished[-1] - self.finished[0] if len(self.finished) > 1 else 0
+        return {"requests": self.count,
+                "throughput": (len(self.finished) - 1) / span if span > 0 else 0.,     # requests per second
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.}
+
+
+class MicroBatcher:
+    def __init__(self, model, max_batch_size=64, max_delay_ms=5, num_workers=2, cache_size=0, device="cpu", max_size=64):
+        """
+        Groups single images into batches: a batch is run as soon as it has max_batch_size images or its first image has
+        waited max_delay_ms, so the fixed cost of DTM and persistence per call is shared by all images of the batch.
+        Batches run on a pool of worker threads, which keeps the event loop free to accept requests meanwhile. Threads only
+        overlap the torch ops of batches (DTM, convolutions, fc layers): persistence runs python code for every image and
+        holds the GIL, so more workers don't run more of it at once. If a batch fails, its images are run one at a time so
+        that a bad image only fails its own request. Images may have different sizes, see ragged_apply.
+
+        Args:
+            model: Classifier taking Tensor of shape [batch_size, C, H, W]
+            max_batch_size: Max number of images per batch
+            max_delay_ms: Max time an image waits for its batch to fill
+            num_workers: Number of batches run at the same time, see above
+            cache_size: Number of predictions kept for repeated images (by hash of their contents), 0 to disable
+            device: Device of the model
+            max_size: Max height and width of an image. DTM keeps a neighbor table of (H*W) x k entries per size
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.device = device
+        self.pool = ThreadPoolExecutor(num_workers)
+        self.slots = None
+        self.num_workers = num_workers
+        self.queue = None
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # digest -> probabilities
+        self.stats = LatencyStats()
+        self.in_channels = _in_channels(model)
+        self.max_size = max_size
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.num_workers)
+        asyncio.create_task(self._loop())
+
+    async def predict(self, image):
+        """
+        Args:
+            image: Tensor of shape [C, H, W]
+        Returns:
+            probabilities: Tensor of shape [num_classes, ]
+        """
+        start = time.perf_counter()
+        key = _digest(image) if self.cache_size else None
+        if key is not None and key in self.cache:
+            self.cache.move_to_end(key)
+            output = self.cache[key]
+        else:
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((image, future))
+            output = await future
+            if key is not None:
+                self.cache[key] = output
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        self.stats.add(time.perf_counter() - start)
+        return output
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.slots.acquire()     # more batches keep queueing while all workers are busy
+            asyncio.create_task(self._run(batch))
+
+    async def _run(self, batch):
+        images, futures = zip(*batch)
+        self.stats.batch_sizes.append(len(batch))
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                output = await loop.run_in_executor(self.pool, self._forward, list(images))
+            except Exception as e:
+                output = [e] if len(images) == 1 else None
+            if output is None:
+                output = []
+                for image in images:
+                    try:
+                        output.append((await loop.run_in_executor(self.pool, self._forward, [image]))[0])
+                    except Exception as e:
+                        output.append(e)
+            for future, result in zip(futures, output):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            self.slots.release()
+
+    def _forward(self, images):
+        with torch.no_grad():   # images of different sizes run as one batch per size
+            return ragged_apply(lambda x: self.model(x.to(self.device)).softmax(-1).cpu(), images)
+
+
+async def _respond(writer, status, body):
+    data = json.dumps(body).encode()
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+    await writer.drain()
+
+
+async def handle(batcher, reader, writer):
+    """
+    Minimal HTTP/1.1 with keep-alive:
+        POST /predict with json {"image": [C][H][W] nested lists} -> {"label": int, "probabilities": [...]}
+        GET /stats -> latency and throughput, see LatencyStats.report
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, _ = request_line.decode().split(" ", 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, value = line.decode().split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            if method == "POST" and target == "/predict":
+                try:
+                    image = torch.tensor(json.loads(body)["image"], dtype=torch.float32)
+                except (ValueError, KeyError, TypeError) as e:
+                    await _respond(writer, "400 Bad Request", {"error": str(e)})
+                    continue
+                # checked before queueing, an image the model can't take would fail its whole micro-batch
+                if image.dim() != 3 or (batcher.in_channels is not None and image.shape[0] != batcher.in_channels):
+                    await _respond(writer, "400 Bad Request",
+                                   {"error": f"expected image of shape [{batcher.in_channels}][H][W], got {list(image.shape)}"})
+                    continue
+                if max(image.shape[1:]) > batcher.max_size:
+                    await _respond(writer, "400 Bad Request",
+                                   {"error": f"image of size {list(image.shape[1:])} exceeds the max size {batcher.max_size}"})
+                    continue
+                try:
+                    probabilities = await batcher.predict(image)
+                except Exception as e:
+                    await _respond(writer, "500 Internal Server Error", {"error": f"{type(e).__name__}: {e}"})
+                    continue
+                await _respond(writer, "200 OK", {"label": int(probabilities.argmax()), "probabilities": probabilities.tolist()})
+            elif method == "GET" and target == "/stats":
+                await _respond(writer, "200 OK", batcher.stats.report())
+            else:
+                await _respond(writer, "404 Not Found", {"error": f"{method} {target}"})
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def main(args):
+    model = load_exported(args.model, args.device)
+    if args.surrogates is not None:
+        use_surrogates(model, load_surrogates(args.surrogates, args.device))
+    batcher = MicroBatcher(model, args.max_batch_size, args.max_delay_ms, args.workers, args.cache_size, args.device, args.max_size)
+    await batcher.start()
+    callback = lambda reader, writer: handle(batcher, reader, writer)
+    if args.unix is not None:
+        server = await asyncio.start_unix_server(callback, args.unix)
+        print(f"Serving {args.model} on {args.unix}")
+    else:
+        server = await asyncio.start_server(callback, args.host, args.port)
+        print(f"Serving {args.model} on http://{args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="model exported with export.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix", help="path of a unix socket to serve on instead of host and port")
+    parser.add_argument("--surrogates", help="surrogates of the topology branches written by surrogate.py, skips persistence")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-delay-ms", type=float, default=5, help="max time a request waits for its batch to fill")
+    parser.add_argument("--workers", type=int, default=2, help="number of batches run at the same time. Threads, so they overlap "
+                                                                "torch ops but not the persistence, which holds the GIL")
+    parser.add_argument("--cache-size", type=int, default=0, help="number of predictions kept for repeated images")
+    parser.add_argument("--max-size", type=int, default=64, help="max height and width of an image, larger ones are rejected")
+    args = parser.parse_args()
+    asyncio.run(main(args))
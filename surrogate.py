@@ -0,0 +1,253 @@
+import math
+import time
+import argparse
+from collections import defaultdict
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset, DataLoader
+from torch.optim import Adam
+from eclay import EC_Layer
+from pllay import PL_Layer
+from cache import FeatureCache, make_cache
+from export import load_exported
+
+
+class TopoSurrogate(nn.Module):
+    def __init__(self, in_channels, feature_shape, hidden_channels=[16, 32, 64], hidden_features=128):
+        """
+        Small CNN predicting the output of a topology branch before gtheta_layer (DTM followed by EC_Layer or PL_Layer)
+        straight from the image. Targets are standardized with mean and std, which are kept as buffers.
+
+        Args:
+            in_channels: Number of channels of input data
+            feature_shape: Shape of the features of one sample, e.g. [num_channels, T] for EC_Layer
+            hidden_channels: List containing the number of filters of each conv layer
+            hidden_features: Dimension of the hidden fc layer
+        """
+        super().__init__()
+        self.feature_shape = list(feature_shape)
+        layer_list, channels = [], in_channels
+        for i, num_filters in enumerate(hidden_channels):
+            layer_list += [nn.Conv2d(channels, num_filters, kernel_size=3, stride=(1 if i==0 else 2), padding=1),
+                           nn.BatchNorm2d(num_filters),
+                           nn.ReLU()]
+            channels = num_filters
+        self.conv_layer = nn.Sequential(*layer_list)
+        self.pool = nn.Sequential(nn.AdaptiveAvgPool2d(4), nn.Flatten())   # counts of components and holes are sums over the image
+        self.fc = nn.Sequential(nn.Linear(16 * channels, hidden_features),
+                                nn.ReLU(),
+                                nn.Linear(hidden_features, math.prod(feature_shape)))
+        self.register_buffer("mean", torch.zeros(feature_shape))
+        self.register_buffer("std", torch.ones(feature_shape))
+
+    def forward(self, input, normalized=False):
+        """
+        Args:
+            input: Tensor of shape [batch_size, C, H, W]
+            normalized: Whether to return the standardized features, used for training
+        Returns:
+            output: Tensor of shape [batch_size, *feature_shape]
+        """
+        x = self.conv_layer(input)
+        x = self.pool(x)
+        x = self.fc(x).view(-1, *self.feature_shape)
+        return x if normalized else self.mean + self.std * x
+
+
+class SurrogateFeatures:
+    def __init__(self, model, surrogates):
+        """
+        Stand-in for the feature_cache of the models: the features of each topology branch are predicted by its surrogate
+        instead of computing DTM and persistence. gtheta_layer and the rest of the model are unchanged.
+
+        Args:
+            model: Model whose topology branches are replaced
+            surrogates: dict name of EC_Layer/PL_Layer in model (e.g. "topo_layer_1.ec_layer") -> TopoSurrogate
+        """
+        self.surrogates = {model.get_submodule(name): surrogate for name, surrogate in surrogates.items()}
+
+    def __call__(self, input, branch):
+        if branch[-1] not in self.surrogates:   # branch without surrogate
+            return FeatureCache._apply(branch, input)
+        return self.surrogates[branch[-1]](input)
+
+
+class _TeacherFeatures:
+    def __init__(self, model, feature_cache=None):
+        """
+        Stand-in for the feature_cache of model that records the features of every topology branch, taken from
+        feature_cache if given (e.g. the topo_cache of a sweep) so that features computed before are reused.
+        """
+        self.names = {m: name for name, m in model.named_modules() if isinstance(m, (EC_Layer, PL_Layer))}
+        self.feature_cache = feature_cache
+        self.features = defaultdict(list)   # name -> list of Tensor
+
+    def __call__(self, input, branch):
+        with torch.no_grad():
+            output = FeatureCache._apply(branch, input) if self.feature_cache is None else self.feature_cache(input, branch)
+        self.features[self.names[branch[-1]]].append(output.cpu())
+        return output
+
+
+def use_surrogates(model, surrogates):
+    """
+    Args:
+        model: Model with feature_cache, e.g. EC_CNN_2, PL_CNN_2 or EClayResNet
+        surrogates: dict name -> TopoSurrogate, see SurrogateFeatures. If None, the exact topology branches are used
+    Returns:
+        model: same model, without any cache of topological features
+    """
+    if hasattr(model, "frozen_cache"):
+        model.frozen_cache = None   # would bypass the surrogates of frozen EC branches
+    model.feature_cache = None if surrogates is None else SurrogateFeatures(model, surrogates)
+    return model
+
+
+def teacher_features(model, x, feature_cache=None, batch_size=256, device="cpu"):
+    """
+    Args:
+        model: Trained model
+        x: Tensor of shape [N, C, H, W]
+        feature_cache: FeatureCache, dict of its arguments or None
+    Returns:
+        features: dict name of EC_Layer/PL_Layer -> Tensor of shape [N, *feature_shape]
+    """
+    feature_caches = model.feature_cache, getattr(model, "frozen_cache", None)
+    recorder = _TeacherFeatures(model, make_cache(feature_cache))
+    use_surrogates(model, None).feature_cache = recorder
+    model.eval()
+    try:
+        with torch.no_grad():
+            for i in range(0, len(x), batch_size):
+                model(x[i:i+batch_size].float().to(device))
+    finally:
+        model.feature_cache = feature_caches[0]
+        if hasattr(model, "frozen_cache"):
+            model.frozen_cache = feature_caches[1]
+    return {name: torch.concat(features) for name, features in recorder.features.items()}
+
+
+def distill(x, features, epochs=30, batch_size=64, lr=1e-3, device="cpu", **surrogate_params):
+    """
+    Trains one TopoSurrogate per topology branch to regress the teacher features.
+
+    Args:
+        x: Tensor of shape [N, C, H, W]
+        features: dict name -> Tensor of shape [N, *feature_shape], see teacher_features
+        surrogate_params: arguments of TopoSurrogate
+    Returns:
+        surrogates: dict name -> TopoSurrogate in eval mode
+    """
+    names = list(features)
+    surrogates = {}
+    for name in names:
+        surrogate = TopoSurrogate(x.shape[1], features[name].shape[1:], **surrogate_params)
+        surrogate.mean.copy_(features[name].mean(0))
+        surrogate.std.copy_(features[name].std(0).clamp(min=1e-3))     # constant features (e.g. beyond the last death)
+        surrogates[name] = surrogate.to(device)
+    parameters = [p for surrogate in surrogates.values() for p in surrogate.parameters()]
+    optimizer = Adam(parameters, lr)
+    dataloader = DataLoader(TensorDataset(x, *[features[name] for name in names]), batch_size, shuffle=True)
+    for epoch in range(1, epochs + 1):
+        epoch_loss = defaultdict(float)
+        for surrogate in surrogates.values():
+            surrogate.train()
+        for X, *targets in dataloader:
+            X = X.float().to(device)
+            loss = 0
+            for name, target in zip(names, targets):
+                surrogate = surrogates[name]
+                target = (target.to(device) - surrogate.mean) / surrogate.std
+                branch_loss = nn.functional.mse_loss(surrogate(X, normalized=True), target)
+                epoch_loss[name] += branch_loss.item() * len(X)
+                loss = loss + branch_loss
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        print(f"Epoch {epoch}: " + ", ".join(f"{name} {loss / len(x):>6f}" for name, loss in epoch_loss.items()))
+    return {name: surrogate.eval() for name, surrogate in surrogates.items()}
+
+
+def save_surrogates(surrogates, path):
+    torch.save({name: {"params": {"in_channels": s.conv_layer[0].in_channels, "feature_shape": s.feature_shape,
+                                  "hidden_channels": [m.out_channels for m in s.conv_layer if isinstance(m, nn.Conv2d)],
+                                  "hidden_features": s.fc[0].out_features},
+                       "state_dict": {k: v.cpu() for k, v in s.state_dict().items()}}
+                for name, s in surrogates.items()}, path)
+
+
+def load_surrogates(path, device="cpu"):
+    """
+    Returns:
+        surrogates: dict name -> TopoSurrogate in eval mode, see save_surrogates
+    """
+    surrogates = {}
+    for name, entry in torch.load(path, map_location="cpu").items():
+        surrogate = TopoSurrogate(**entry["params"])
+        surrogate.load_state_dict(entry["state_dict"])
+        surrogates[name] = surrogate.to(device).eval()
+    return surrogates
+
+
+def report(model, surrogates, x, y, batch_size=64, device="cpu"):
+    """
+    Accuracy and latency of model with the exact topology branches and with the surrogates.
+
+    Args:
+        model: Trained model
+        surrogates: dict name -> TopoSurrogate
+        x: Tensor of shape [N, C, H, W]
+        y: Tensor of shape [N, ]
+    Returns:
+        results: dict "exact"/"surrogate" -> dict of accuracy (%), ms_per_batch (median) and images_per_sec
+    """
+    results = {}
+    model.eval()
+    for mode, s in (("exact", None), ("surrogate", surrogates)):
+        use_surrogates(model, s)
+        correct, times = 0, []
+        with torch.no_grad():
+            for i in range(0, len(x), batch_size):
+                X, Y = x[i:i+batch_size].float().to(device), y[i:i+batch_size].to(device)
+                start = time.perf_counter()
+                y_pred = model(X)
+                if device != "cpu":
+                    torch.cuda.synchronize(device)
+                times.append(time.perf_counter() - start)
+                correct += (y_pred.argmax(1) == Y).sum().item()
+        results[mode] = {"accuracy": 100 * correct / len(y), "ms_per_batch": 1000 * float(np.median(times)),
+                         "images_per_sec": len(y) / sum(times)}
+    print(f"{'':>10s} {'Accuracy':>9s} {'ms/batch':>9s} {'images/s':>9s}")
+    for mode, r in results.items():
+        print(f"{mode:>10s} {r['accuracy']:>8.1f}% {r['ms_per_batch']:>9.2f} {r['images_per_sec']:>9.1f}")
+    print(f"Accuracy loss: {results['exact']['accuracy'] - results['surrogate']['accuracy']:>0.1f}%p, "
+          f"speedup: {results['surrogate']['images_per_sec'] / results['exact']['images_per_sec']:>0.1f}x")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="model exported with export.py")
+    parser.add_argument("x_path", help="generated data, e.g. MNIST/generated_data/x_00_00.pt")
+    parser.add_argument("y_path", help="labels, e.g. MNIST/generated_data/y.pt")
+    parser.add_argument("output", help="file of the surrogates")
+    parser.add_argument("--cache-dir", help="shared_dir of a FeatureCache with teacher features, e.g. MNIST/topo_cache")
+    parser.add_argument("--eval-only", action="store_true", help="only report the surrogates already in output")
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = load_exported(args.model, args.device)
+    x_train, x_test = torch.load(args.x_path)
+    y_train, y_test = torch.load(args.y_path)
+    if args.eval_only:
+        surrogates = load_surrogates(args.output, args.device)
+    else:
+        feature_cache = None if args.cache_dir is None else {"shared_dir": args.cache_dir}
+        features = teacher_features(model, x_train, feature_cache, device=args.device)
+        surrogates = distill(x_train, features, args.epochs, args.batch_size, args.lr, args.device)
+        save_surrogates(surrogates, args.output)
+    report(model, surrogates, x_test, y_test, args.batch_size, args.device)
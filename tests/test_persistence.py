@@ -0,0 +1,277 @@
+import pytest
+import torch
+from persistence import BACKENDS, cubical_persistence, grid_persistence, quantized_persistence
+from eclay import EC_Layer
+from pllay import PL_Layer
+
+gudhi = pytest.importorskip("gudhi")
+
+
+def make_images(kind, seed, shape=(3, 2, 9, 7)):
+    """
+    Args:
+        kind: "random" (no ties), "ties" (few integer levels, so flat regions and tied merges) or "constant"
+    Returns:
+        images: Tensor of shape [batch_size, C, H, W]
+    """
+    generator = torch.Generator().manual_seed(seed)
+    if kind == "random":
+        return torch.rand(shape, generator=generator)
+    if kind == "ties":
+        return torch.randint(0, 4, shape, generator=generator).float()
+    return torch.full(shape, 2.)
+
+
+def points(diagrams):
+    """
+    Returns:
+        points: list of sorted (birth, death) of each group, without points of zero persistence
+    """
+    point_list = []
+    for g in range(diagrams.num_groups):
+        lo, hi = diagrams.offsets[g] - diagrams.offsets[0], diagrams.offsets[g+1] - diagrams.offsets[0]
+        birth, death = diagrams.birth[lo:hi].tolist(), diagrams.death[lo:hi].tolist()
+        point_list.append(sorted((b, d) for b, d in zip(birth, death) if b != d))
+    return point_list
+
+
+def grad_per_value(input, grad):
+    """
+    Sums the gradient over the pixels of equal value of each image and channel. When values tie, each backend may attach a
+    point to a different pixel of the same value (both are valid subgradients), but the gradient per value is the same.
+
+    Returns:
+        grads: list of dict value -> gradient
+    """
+    grads = []
+    for values, g in zip(input.flatten(0, 1).flatten(1), grad.flatten(0, 1).flatten(1)):
+        unique, inverse = values.unique(return_inverse=True)
+        grads.append(dict(zip(unique.tolist(), torch.zeros(len(unique), dtype=g.dtype).index_add_(0, inverse, g).tolist())))
+    return grads
+
+
+@pytest.mark.parametrize("kind", ["random", "ties", "constant"])
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("superlevel", [False, True])
+@pytest.mark.parametrize("cutoff", [None, 0.5, 2.])
+def test_grid_matches_gudhi(kind, seed, superlevel, cutoff):
+    input = make_images(kind, seed)
+    expected = cubical_persistence(input, superlevel, [0, 1], cutoff=cutoff)
+    for simplify in (True, False):
+        diagrams = grid_persistence(input, superlevel, [0, 1], simplify=simplify, cutoff=cutoff)
+        assert diagrams.dimensions == expected.dimensions and len(diagrams) == len(expected)
+        assert points(diagrams) == points(expected)
+
+
+@pytest.mark.parametrize("shape", [(1, 1, 1, 1), (1, 1, 1, 8), (1, 1, 8, 1), (2, 1, 2, 2), (1, 3, 16, 16)])
+def test_grid_matches_gudhi_shapes(shape):
+    for kind in ("random", "ties"):
+        input = make_images(kind, 0, shape)
+        for dimensions in ([0], [1], [0, 1]):
+            assert points(grid_persistence(input, False, dimensions)) == points(cubical_persistence(input, False, dimensions))
+
+
+@pytest.mark.parametrize("kind", ["random", "ties", "constant"])
+@pytest.mark.parametrize("superlevel", [False, True])
+def test_ec_layer_backends(kind, superlevel):
+    input = make_images(kind, 1)
+    start, end = (-1, 0) if superlevel else (0, 1)
+    if kind != "random":
+        start, end = 3 * start, 3 * end
+    outputs = [EC_Layer(superlevel, start, end, T=25, num_channels=2, backend=backend)(input) for backend in ("gudhi", "grid")]
+    assert torch.equal(outputs[0], outputs[1])
+
+
+@pytest.mark.parametrize("kind", ["random", "ties", "constant"])
+@pytest.mark.parametrize("superlevel", [False, True])
+def test_pl_layer_backends(kind, superlevel):
+    input = make_images(kind, 2)
+    start, end = (-1, 0) if superlevel else (0, 1)
+    if kind != "random":
+        start, end = 3 * start, 3 * end
+    # T=24 keeps tseq off the half integers, where tents of integer points tie and the landscape itself picks a point by order
+    weight = torch.randn(3, 2, 2, 3, 24, generator=torch.Generator().manual_seed(0))
+    outputs, grads = [], []
+    for backend in ("gudhi", "grid"):
+        x = input.clone().requires_grad_()
+        landscape = PL_Layer(superlevel, start, end, T=24, K_max=3, num_channels=2, backend=backend)(x)
+        (landscape * weight).sum().backward()
+        outputs.append(landscape.detach())
+        grads.append(x.grad)
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-6)
+    if kind == "random":
+        assert torch.allclose(grads[0], grads[1], atol=1e-6)
+    else:
+        for expected, actual in zip(grad_per_value(input, grads[0]), grad_per_value(input, grads[1])):
+            assert expected.keys() == actual.keys()
+            assert all(abs(expected[v] - actual[v]) < 1e-5 for v in expected)
+
+
+def components(mask, connectivity):
+    """
+    Connected components of a boolean image by breadth-first search, independent of the persistence code.
+
+    Args:
+        mask: list of lists of bool
+        connectivity: 4 or 8
+    Returns:
+        components: list of sets of (row, column)
+    """
+    H, W = len(mask), len(mask[0])
+    steps = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dy or dx) and (connectivity == 8 or not (dy and dx))]
+    seen, component_list = set(), []
+    for start in ((i, j) for i in range(H) for j in range(W) if mask[i][j]):
+        if start in seen:
+            continue
+        seen.add(start)
+        component, queue = {start}, [start]
+        while queue:
+            i, j = queue.pop()
+            for dy, dx in steps:
+                p = (i + dy, j + dx)
+                if 0 <= p[0] < H and 0 <= p[1] < W and mask[p[0]][p[1]] and p not in seen:
+                    seen.add(p)
+                    component.add(p)
+                    queue.append(p)
+        component_list.append(component)
+    return component_list
+
+
+def betti(image, t):
+    """
+    Betti numbers of the sublevel set {image <= t} of the cubical complex of top dimensional cells. Pixels sharing a corner are
+    connected, and by Alexander duality the holes are the 4-connected components of the complement that don't touch the border.
+    """
+    H, W = len(image), len(image[0])
+    b0 = len(components([[v <= t for v in row] for row in image], 8))
+    holes = [c for c in components([[v > t for v in row] for row in image], 4)
+             if not any(i in (0, H - 1) or j in (0, W - 1) for i, j in c)]
+    return b0, len(holes)
+
+
+PATTERNS = [
+    [[1, 0, 1],
+     [0, 1, 0],
+     [1, 0, 1]],        # ring of pixels touching at corners around one pixel: one component and one hole
+    [[0, 1, 0, 1],
+     [1, 0, 1, 0],
+     [0, 1, 0, 1],
+     [1, 0, 1, 0]],     # checkerboard: diagonals connect the foreground, the complement has no 4-connected hole
+    [[1, 1, 1, 1, 1],
+     [1, 0, 0, 0, 1],
+     [1, 0, 2, 0, 1],
+     [1, 0, 0, 3, 1],
+     [1, 1, 1, 1, 1]],  # hole of two pixels touching at a corner, split into two holes at t=0 only if 4-connected
+    [[0, 2, 2, 2, 0],
+     [2, 2, 0, 2, 2],
+     [2, 0, 1, 0, 2],
+     [2, 2, 0, 2, 2],
+     [0, 2, 2, 2, 0]],  # diamond around the center, foreground components at the corners
+]
+
+
+@pytest.mark.parametrize("image", PATTERNS + [make_images(kind, seed, (1, 1, 8, 8))[0, 0].tolist()
+                                              for kind in ("random", "ties") for seed in range(5)])
+def test_betti_numbers(image):
+    input = torch.tensor(image, dtype=torch.float).view(1, 1, len(image), len(image[0]))
+    values = sorted({v for row in image for v in row})
+    thresholds = values[:-1] + [(a + b) / 2 for a, b in zip(values, values[1:])]     # the essential class is paired with the maximum
+    for diagrams in (grid_persistence(input, False, [0, 1]), cubical_persistence(input, False, [0, 1])):
+        birth, death, group = diagrams.birth.tolist(), diagrams.death.tolist(), diagrams.group.tolist()
+        for t in thresholds:
+            alive = [b <= t < d for b, d in zip(birth, death)]
+            assert (sum(a for a, g in zip(alive, group) if g == 0), sum(a for a, g in zip(alive, group) if g == 1)) == betti(image, t)
+
+
+@pytest.mark.parametrize("backend", ["gudhi", "grid"])
+@pytest.mark.parametrize("kind", ["random", "ties"])
+@pytest.mark.parametrize("cutoff", [0.3, 0.5, 2.])
+def test_truncated_diagrams(backend, kind, cutoff):
+    input = make_images(kind, 3) / (1 if kind == "random" else 3)
+    full = BACKENDS[backend](input, False, [0, 1])
+    truncated = BACKENDS[backend](input, False, [0, 1], cutoff=cutoff)
+    cutoff = torch.tensor(cutoff).item()    # diagrams are float32
+    expected = [sorted((b, min(d, cutoff)) for b, d in group if b < cutoff) for group in points(full)]
+    assert points(truncated) == expected
+    assert (truncated.index[truncated.death == cutoff, 1] == -1).all()   # truncated deaths don't depend on a pixel
+
+
+def untruncated(layer):
+    """
+    Same layer computing the whole filtration, without the cutoff its forward uses.
+    """
+    def diagrams(input):
+        dimensions = layer.dimensions if isinstance(layer, PL_Layer) else [0, 1]
+        return BACKENDS[layer.backend](input.detach().cpu(), layer.superlevel, dimensions)
+    if isinstance(layer, PL_Layer):
+        layer._diagrams = diagrams
+    else:
+        layer.diagrams = diagrams
+    return layer
+
+
+@pytest.mark.parametrize("backend", ["gudhi", "grid"])
+@pytest.mark.parametrize("kind", ["random", "ties"])
+@pytest.mark.parametrize("superlevel", [False, True])
+def test_truncated_ec_layer(backend, kind, superlevel):
+    input = make_images(kind, 4) / (1 if kind == "random" else 3)
+    start, end = (-1, -0.5) if superlevel else (0, 0.5)
+    layers = [EC_Layer(superlevel, start, end, T=24, num_channels=2, backend=backend) for _ in range(2)]
+    assert torch.equal(layers[0](input), untruncated(layers[1])(input))
+
+
+@pytest.mark.parametrize("backend", ["gudhi", "grid"])
+@pytest.mark.parametrize("kind", ["random", "ties"])
+@pytest.mark.parametrize("superlevel", [False, True])
+def test_truncated_pl_layer(backend, kind, superlevel):
+    input = make_images(kind, 5) / (1 if kind == "random" else 3)
+    start, end = (-1, -0.7) if superlevel else (0, 0.3)     # cutoff 2*end - min is inside the range of values
+    weight = torch.randn(3, 2, 2, 3, 24, generator=torch.Generator().manual_seed(0))
+    layers = [PL_Layer(superlevel, start, end, T=24, K_max=3, num_channels=2, backend=backend) for _ in range(2)]
+    outputs, grads = [], []
+    for layer in (layers[0], untruncated(layers[1])):
+        x = input.clone().requires_grad_()
+        landscape = layer(x)
+        (landscape * weight).sum().backward()
+        outputs.append(landscape.detach())
+        grads.append(x.grad)
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-6)
+    if kind == "random":
+        assert torch.allclose(grads[0], grads[1], atol=1e-6)
+    else:
+        for expected, actual in zip(grad_per_value(input, grads[0]), grad_per_value(input, grads[1])):
+            assert all(abs(expected[v] - actual[v]) < 1e-5 for v in expected)
+
+
+@pytest.mark.parametrize("kind", ["random", "ties", "constant"])
+@pytest.mark.parametrize("superlevel", [False, True])
+@pytest.mark.parametrize("step", [None, 0.01, 0.1])
+def test_quantized_diagrams(kind, superlevel, step):
+    input = make_images(kind, 6)
+    exact = grid_persistence(input, superlevel, [0, 1])
+    quantized = quantized_persistence(input, superlevel, [0, 1], step=step, offset=None if step is None else 0.)
+    if step is None:    # range of the batch split into 65534 levels
+        step = max(input.max().item() - input.min().item(), 1e-12) / 65534
+    for expected, actual in zip(points(exact), points(quantized)):
+        assert gudhi.bottleneck_distance(expected, actual) <= step / 2 + 1e-6
+
+
+@pytest.mark.parametrize("superlevel", [False, True])
+@pytest.mark.parametrize("seed", range(3))
+def test_quantized_ec_layer(superlevel, seed):
+    input = make_images("random", seed)     # values on tseq could fall on either side of it after rounding
+    start, end = (-1, -0.25) if superlevel else (0, 0.75)
+    outputs = [EC_Layer(superlevel, start, end, T=16, num_channels=2, backend=backend)(input) for backend in ("grid", "quantized")]
+    assert torch.equal(outputs[0], outputs[1])
+
+
+@pytest.mark.parametrize("kind", ["random", "ties"])
+@pytest.mark.parametrize("superlevel", [False, True])
+@pytest.mark.parametrize("subdivision", [1, 8])
+def test_quantized_pl_layer(kind, superlevel, subdivision):
+    input = make_images(kind, 7) / (1 if kind == "random" else 3)
+    start, end, T = (-1, -0.25, 16) if superlevel else (0, 0.75, 16)
+    tolerance = (end - start) / (2 * (T - 1) * subdivision)
+    outputs = [PL_Layer(superlevel, start, end, T, K_max=3, num_channels=2, backend=backend, subdivision=subdivision)(input)
+               for backend in ("grid", "quantized")]
+    assert (outputs[0] - outputs[1]).abs().max().item() <= tolerance + 1e-6
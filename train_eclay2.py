@@ -3,7 +3,7 @@ import os
 import wandb
 import argparse
 from models_base import EClay2
-from train_test import train_val_wandb, train_test_wandb, train_val, train_test
+from train_test import train_val_wandb, train_test_wandb, train_val, train_test, test_ensemble
 
 
 # for reproducibility (may degrade performance)
@@ -13,6 +13,7 @@ torch.manual_seed(123)
 
 parser = argparse.ArgumentParser()
 parser.add_argument("data", help="directory of the dataset")
+parser.add_argument("--ensemble", action="store_true", help="evaluate the ensemble of the saved simulations instead of training")
 args = parser.parse_args()
 
 project = "EClayDTM_" + args.data
@@ -76,6 +77,11 @@ if __name__ == "__main__":
         print(f"Corruption/Noise rate: {file_cn_list[i_cn]}")
         print("-"*30)
         
+        if args.ensemble:
+            weight_paths = [weight_dir_list[i_cn] + f"sim{n_sim}.pt" for n_sim in range(1, config["ntimes"]+1)]
+            test_ensemble(EClay2, config, x_path_list[i_cn], y_path, weight_paths)
+            continue
+
         # loop over number of simulations
         for n_sim in range(1, config["ntimes"]+1):
             print(f"\nSimulation: [{n_sim} / {config['ntimes']}]")
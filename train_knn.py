@@ -0,0 +1,61 @@
+import torch
+import argparse
+from sklearn.metrics import classification_report
+from dtm import DTMLayer
+from persistence import grid_persistence
+from diagram import DiagramBatch
+from diagram_index import DiagramIndex
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("data", help="directory of the dataset")
+parser.add_argument("-k", type=int, default=5, help="number of neighbors")
+args = parser.parse_args()
+
+# DTM, index and search params
+config = {
+    "batch_size": 256,
+    "m0": 0.05,
+    "lims": [[1,28], [1,28]],
+    "size": [28, 28],
+    "r": 2,
+    "num_directions": 16,
+    "resolution": 64,
+    "num_components": 128,
+    "num_candidates": 64,
+    }
+
+corrupt_prob_list = [0.0]
+noise_prob_list = [0.0]
+len_cn = len(corrupt_prob_list)
+file_cn_list = []
+for i_cn in range(len_cn):
+    file_cn_list.append(str(int(corrupt_prob_list[i_cn] * 100)).zfill(2) + "_" + str(int(noise_prob_list[i_cn] * 100)).zfill(2))
+x_path_list = [f"{args.data}/generated_data/x_" + file_cn_list[i] + ".pt" for i in range(len_cn)]
+y_path = f"{args.data}/generated_data/y.pt"
+
+
+def diagrams_of(x, dtm):
+    with torch.no_grad():
+        return DiagramBatch.cat([grid_persistence(dtm(batch)) for batch in x.split(config["batch_size"])])
+
+
+if __name__ == "__main__":
+    dtm = DTMLayer(config["m0"], config["lims"], config["size"], config["r"])
+    y_train, y_test = torch.load(y_path)
+
+    # loop over data with different corruption/noise probability
+    for i_cn in range(len_cn):
+        print("-"*30)
+        print(f"Corruption/Noise rate: {file_cn_list[i_cn]}")
+        print("-"*30)
+        x_train, x_test = torch.load(x_path_list[i_cn])
+
+        index = DiagramIndex(config["num_directions"], config["resolution"], config["num_components"], config["num_candidates"])
+        index.add(diagrams_of(x_train, dtm), y_train)
+        test_diagrams = diagrams_of(x_test, dtm)
+        predicted = torch.cat([index.predict(test_diagrams[i:i+config["batch_size"]], args.k)
+                               for i in range(0, len(test_diagrams), config["batch_size"])])
+        accuracy = (predicted == y_test).float().mean().item() * 100
+        print(f"Test error:\n Accuracy: {(accuracy):>0.1f}% \n")
+        print(classification_report(y_test, predicted, zero_division="warn"))
@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
@@ -8,6 +9,7 @@ from sklearn.metrics import classification_report
 from collections import defaultdict
 import matplotlib.pyplot as plt
 from models import EClayResNet, EC_CNN_2, PL_CNN_2
+from ensemble import Ensemble
 import os
 import wandb
 
@@ -251,4 +253,53 @@ def train_test_wandb(MODEL, config, x_path, y_path, seed, weight_path, log_metri
     """
     with wandb.init(config=config, project=project, group=group, job_type=job_type):
         config = wandb.config
-        train_test(MODEL, config, x_path, y_path, seed, weight_path, log_metric, log_grad, val_metric)
\ No newline at end of file
+        train_test(MODEL, config, x_path, y_path, seed, weight_path, log_metric, log_grad, val_metric)
+
+def test_ensemble(MODEL, config, x_path, y_path, weight_paths, log_metric=False):
+    """
+    Evaluates each saved simulation and their ensemble (mean of the predicted probabilities) on test data.
+    Topological features are computed once for all members, see Ensemble.
+
+    Args:
+        MODEL:
+        config:
+        x_path: file path to data
+        y_path: file path to label
+        weight_paths: file paths to the trained weights of the members, e.g. sim1.pt, ..., sim{ntimes}.pt
+        log_metric: whether to log metrics to wandb
+    """
+    test_dataset = CustomDataset(x_path, y_path, mode="test")
+    test_dataloader = DataLoader(test_dataset, config["batch_size"])
+    ensemble = Ensemble(MODEL, config["model_params"], weight_paths, config["device"])
+    nll_fn = nn.NLLLoss(reduction="sum")
+
+    data_size = len(test_dataset)
+    num_members = len(weight_paths)
+    member_loss, member_correct = torch.zeros(num_members), torch.zeros(num_members)
+    loss, correct = 0, 0
+    y_pred_list = []
+    with torch.no_grad():
+        for X, y in test_dataloader:
+            X, y = X.to(config["device"]), y.to(config["device"])
+            log_prob = ensemble(X).log_softmax(-1)     # shape: [num_members, batch_size, num_classes]
+            member_loss += torch.stack([nll_fn(member, y) for member in log_prob]).cpu()
+            member_correct += (log_prob.argmax(-1) == y).sum(-1).cpu()
+            mean_log_prob = log_prob.logsumexp(0) - math.log(num_members)   # log of the mean probability
+            loss += nll_fn(mean_log_prob, y).item()
+            correct += (mean_log_prob.argmax(-1) == y).sum().item()
+            y_pred_list.append(mean_log_prob.argmax(-1))
+    member_loss, member_acc = member_loss / data_size, member_correct / data_size * 100
+    loss /= data_size
+    accuracy = (correct / data_size) * 100
+    for i, path in enumerate(weight_paths):
+        print(f"{os.path.basename(path)}: Accuracy: {member_acc[i]:>0.1f}%, Avg loss: {member_loss[i]:>8f}")
+    print(f"Members: Accuracy: {member_acc.mean():>0.1f}% (+/- {member_acc.std() if num_members > 1 else 0:>0.1f}), Avg loss: {member_loss.mean():>8f}")
+    print(f"Ensemble error:\n Accuracy: {(accuracy):>0.1f}%, Avg loss: {loss:>8f} \n")
+
+    predicted = torch.concat(y_pred_list).detach().to("cpu")
+    _, ground_truth = test_dataset[:]
+    print(classification_report(ground_truth, predicted, zero_division="warn"))
+    if log_metric:
+        wandb.log({"members":{"loss":member_loss.tolist(), "accuracy":member_acc.tolist()},
+                   "ensemble":{"loss":loss, "accuracy":accuracy}})
+    return loss, accuracy